@@ -0,0 +1,99 @@
+import os
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+DIGEST_SIZE = hashlib.sha256().digest_size
+BATCH_BYTES = 4 * 1024 * 1024  # Mỗi task của thread pool hash khoảng 4 MiB dữ liệu
+
+
+def default_workers() -> int:
+    """Returns the number of hashing threads to use (one per CPU core)."""
+    return os.cpu_count() or 1
+
+
+def hash_range(view: memoryview, chunk_size: int, first: int, last: int) -> bytes:
+    """
+    Hash the chunks first..last-1 of a buffer.
+    hashlib releases the GIL while hashing large buffers, so several calls can run in parallel.
+    :param view: A memoryview over the whole file (usually an mmap).
+    :param chunk_size: Size of each chunk in bytes.
+    :return: The raw SHA-256 digests of the chunks, concatenated.
+    """
+    digests = bytearray()
+    for chunk_id in range(first, last):
+        offset = chunk_id * chunk_size
+        data = view[offset:offset + chunk_size]
+        digests += hashlib.sha256(data).digest()
+        data.release()
+    return bytes(digests)
+
+
+def hash_chunks(view: memoryview, chunk_size: int, workers: int = None) -> bytes:
+    """
+    Compute the SHA-256 digest of every chunk of a buffer using a thread pool.
+    :param view: A memoryview over the whole file (usually an mmap).
+    :param chunk_size: Size of each chunk in bytes.
+    :param workers: Number of threads; 1 hashes serially on the calling thread.
+    :return: The raw digests of all chunks, concatenated in chunk order (DIGEST_SIZE bytes each).
+    """
+    total_chunks = (len(view) + chunk_size - 1) // chunk_size
+    workers = workers or default_workers()
+    batch = max(1, BATCH_BYTES // chunk_size)
+    if workers == 1 or total_chunks <= batch:
+        return hash_range(view, chunk_size, 0, total_chunks)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        parts = pool.map(lambda first: hash_range(view, chunk_size, first, min(first + batch, total_chunks)),
+                         range(0, total_chunks, batch))
+        return b''.join(parts)
+
+
+def hash_selected(view: memoryview, chunk_size: int, chunk_ids: list, workers: int = None) -> list:
+    """
+    Compute the SHA-256 digests of selected chunks of a buffer using a thread pool.
+    :param view: A memoryview over the whole file (usually an mmap).
+    :param chunk_size: Size of each chunk in bytes.
+    :param chunk_ids: The chunks to hash.
+    :param workers: Number of threads; 1 hashes serially on the calling thread.
+    :return: The raw digests, in the order of chunk_ids.
+    """
+    workers = workers or default_workers()
+    batch = max(1, BATCH_BYTES // chunk_size)
+
+    def hash_batch(start: int) -> list:
+        digests = []
+        for chunk_id in chunk_ids[start:start + batch]:
+            offset = chunk_id * chunk_size
+            data = view[offset:offset + chunk_size]
+            digests.append(hashlib.sha256(data).digest())
+            data.release()
+        return digests
+
+    starts = range(0, len(chunk_ids), batch)
+    if workers == 1 or len(chunk_ids) <= batch:
+        return [digest for start in starts for digest in hash_batch(start)]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return [digest for part in pool.map(hash_batch, starts) for digest in part]
+
+
+def merkle_root(digests: bytes) -> bytes:
+    """
+    Compute the Merkle root of a list of chunk digests.
+    Each level hashes pairs of nodes; an odd node at the end is carried up unchanged.
+    :param digests: Raw chunk digests, concatenated.
+    :return: The raw root digest (the hash of empty input when there are no chunks).
+    """
+    if not digests:
+        return hashlib.sha256(b'').digest()
+    # Mỗi tầng là một buffer liền (không tạo một object bytes cho mỗi node)
+    level = bytes(digests)
+    pair = 2 * DIGEST_SIZE
+    while len(level) > DIGEST_SIZE:
+        view = memoryview(level)
+        end = len(level) - len(level) % pair
+        next_level = bytearray()
+        for offset in range(0, end, pair):
+            next_level += hashlib.sha256(view[offset:offset + pair]).digest()
+        next_level += view[end:]
+        view.release()
+        level = bytes(next_level)
+    return level
@@ -0,0 +1,437 @@
+import math
+import time
+import socket
+import logging
+import threading
+from struct import error as struct_error
+from FileHandler import FileChunk
+import PeerProtocol
+from PiecePicker import PiecePicker, bits_from_bitfield
+from PeerScore import PeerScore, DEFAULT_MAX_WINDOW
+from Metrics import TimedLock
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WINDOW = 4            # Số request đang chờ trên một peer chưa đo được tốc độ
+DEFAULT_MAX_OUTSTANDING = 32  # Số request tối đa đang chờ trên toàn bộ các peer
+MAX_BAD_CHUNKS = 3            # Số chunk hỏng tối đa trước khi ngắt kết nối một peer
+STALL_TIMEOUT = 30            # Số giây chờ HAVE khi không peer nào có chunk còn thiếu
+REQUEST_TIMEOUT = 10          # Số giây chờ một chunk từ peer chưa đo được tốc độ
+MIN_REQUEST_TIMEOUT = 2       # Thời gian chờ tối thiểu của một request trên peer đã đo được tốc độ
+RTT_TIMEOUT_FACTOR = 4        # Request quá hạn khi đã chờ lâu hơn số lần này RTT trung bình của peer
+MAX_TIMEOUTS = 3              # Số lần quá hạn liên tiếp (không nhận được chunk nào) trước khi ngắt kết nối peer
+ENDGAME_CHUNKS = 8            # Khi chỉ còn chừng này chunk, yêu cầu trùng chúng từ nhiều peer
+
+
+class Downloader:
+    def __init__(self, peer, neighbors: list, window: int = DEFAULT_WINDOW,
+                 max_outstanding: int = DEFAULT_MAX_OUTSTANDING, stall_timeout: float = STALL_TIMEOUT,
+                 max_window: int = DEFAULT_MAX_WINDOW, request_timeout: float = REQUEST_TIMEOUT,
+                 endgame_chunks: int = ENDGAME_CHUNKS):
+        """
+        Download engine that keeps several chunk requests in flight across all neighbors.
+        Each neighbor has one persistent connection on which requests are pipelined; a requester
+        thread sends requests while the neighbor is unchoked and a reader thread handles PIECE,
+        REJECT, HAVE and CHOKE/UNCHOKE messages as they arrive.
+        Every neighbor is scored (PeerScore) as its chunks complete: its window grows with its
+        measured bandwidth-delay product, and the global request budget is shared in proportion
+        to the scores, so most requests go to the fastest peers.
+        A request that is not answered within a few times the neighbor's average latency is
+        cancelled and its chunk goes back to the picker, so another holder can serve it (the
+        neighbor is not asked for that chunk again while an unchoked neighbor has it); a
+        neighbor whose requests keep timing out is disconnected. Once only a few chunks are
+        missing and all of them are requested (endgame), idle neighbors request them again,
+        and the other copies are cancelled when the first one arrives.
+        :param peer: The Peer that owns the download (its file and bitField are filled in).
+        :param neighbors: Neighbor dicts returned by Peer.generate_neighbor.
+        :param window: Number of outstanding requests on a neighbor before its speed is known.
+        :param max_outstanding: Maximum number of outstanding requests in total.
+        :param stall_timeout: Seconds to wait for partial seeders to announce new chunks when
+                              no connected peer has any missing chunk.
+        :param max_window: Maximum number of outstanding requests on one neighbor.
+        :param request_timeout: Seconds to wait for a chunk from a neighbor whose latency is not
+                                measured yet.
+        :param endgame_chunks: Number of missing chunks below which they are requested from
+                               several neighbors at once.
+        """
+        self.peer = peer
+        self.neighbors = neighbors
+        self.window = max(1, int(window))
+        self.max_outstanding = max(1, int(max_outstanding))
+        self.max_window = max(self.window, int(max_window))
+        self.stall_timeout = stall_timeout
+        self.request_timeout = request_timeout
+        self.endgame_chunks = endgame_chunks
+        self.metrics = peer.metrics
+        self.condition = threading.Condition(TimedLock(self.metrics, 'download_lock_wait'))
+        self.outstanding = 0
+        self.requested = {}  # chunk đang được yêu cầu -> số neighbor đang chờ chunk đó (> 1 trong endgame)
+        self.stopped = False
+        self.lastProgress = time.monotonic()
+
+        # Chỉ mục độ hiếm của các mảnh, cập nhật dần theo HAVE / hoàn thành / peer rời đi
+        completed = bits_from_bitfield(peer.bitField)
+        self.picker = PiecePicker(peer.totalChunks, completed)
+        for neighbor in neighbors:
+            neighbor['pending'] = {}     # chunk đã yêu cầu trên kết nối này -> thời điểm gửi request
+            neighbor['cancels'] = []     # chunk cần gửi CANCEL (request quá hạn hoặc đã nhận từ peer khác)
+            neighbor['timeouts'] = 0     # Số lần quá hạn liên tiếp
+            neighbor['excluded'] = 0     # Bitmap các chunk đã quá hạn trên neighbor này, xem _pickable
+            neighbor['alive'] = True
+            neighbor['choked'] = True    # Chỉ gửi request sau khi peer gửi UNCHOKE
+            neighbor['interested'] = False
+            neighbor['name'] = f"{neighbor['ip']}:{neighbor['port']}"
+            # Điểm của peer được giữ lại giữa các lần tải
+            neighbor['score'] = peer.peer_scores.setdefault((neighbor['ip'], neighbor['port']), PeerScore())
+            self.picker.add_peer(neighbor['bits'])
+
+    def run(self) -> bool:
+        """
+        Start the reader and requester threads of every neighbor and wait until the download
+        completes, is stopped, or no peer can provide the missing chunks any more.
+        The threads are joined before returning, so no chunk is written or recorded in the
+        journal after run() returns.
+        :return: True if every chunk has been downloaded, False otherwise.
+        """
+        threads = []
+        for neighbor in self.neighbors:
+            for target in (self._reader, self._requester):
+                thread = threading.Thread(target=target, args=(neighbor,), daemon=True)
+                thread.start()
+                threads.append(thread)
+        with self.condition:
+            while not self.stopped and not self.finished():
+                self._expire_requests()
+                alive = [neighbor for neighbor in self.neighbors if neighbor['alive']]
+                if not alive:
+                    break
+                if self.outstanding == 0 and not any(self.picker.needs_from(n['bits']) for n in alive):
+                    # Không peer nào có chunk còn thiếu: chờ các peer chưa đủ file thông báo HAVE
+                    if time.monotonic() - self.lastProgress >= self.stall_timeout:
+                        break
+                self.condition.wait(1.0)
+            self.stopped = True
+            self.condition.notify_all()
+        for neighbor in self.neighbors:
+            self._close(neighbor['conn'])
+        # Chờ các reader đang ghi dở chunk cuối cùng (kết nối đã đóng nên các thread sẽ thoát ngay sau đó)
+        for thread in threads:
+            thread.join()
+        return self.finished()
+
+    def stop(self):
+        """Stop the download from another thread; run() returns as soon as it wakes up."""
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+
+    def finished(self) -> bool:
+        return self.peer.numDownloaded >= self.peer.totalChunks
+
+    def _requester(self, neighbor: dict):
+        """Báo INTERESTED / NOT_INTERESTED và gửi request theo kiểu pipeline khi neighbor unchoke mình."""
+        conn = neighbor['conn']
+        try:
+            while True:
+                with self.condition:
+                    while True:
+                        if self.stopped or not neighbor['alive'] or self.finished():
+                            return
+                        if neighbor['cancels']:
+                            message = b''.join(PeerProtocol.encode_index(PeerProtocol.CANCEL, i)
+                                               for i in neighbor['cancels'])
+                            neighbor['cancels'].clear()
+                            break
+                        interested = self.picker.needs_from(neighbor['bits'])
+                        if interested != neighbor['interested']:
+                            neighbor['interested'] = interested
+                            message = PeerProtocol.encode_message(
+                                PeerProtocol.INTERESTED if interested else PeerProtocol.NOT_INTERESTED)
+                            break
+                        if not neighbor['choked']:
+                            batch = self._acquire_chunks(neighbor)
+                            if batch:
+                                message = b''.join(PeerProtocol.encode_index(PeerProtocol.REQUEST, i) for i in batch)
+                                break
+                        # Chờ một request hoàn thành, thất bại, UNCHOKE, hoặc neighbor có chunk mới
+                        self.condition.wait()
+                conn.sendall(message)
+        except OSError as e:
+            self._drop_neighbor(neighbor, e)
+
+    def _reader(self, neighbor: dict):
+        """Xử lý các message từ neighbor ngay khi chúng tới."""
+        conn = neighbor['conn']
+        badChunks = 0
+        try:
+            while True:
+                msg_type, payload = PeerProtocol.recv_message(conn)
+                if msg_type == PeerProtocol.PIECE:
+                    received_at = time.perf_counter()
+                    chunk = FileChunk.from_bytes(payload)
+                    with self.condition:
+                        requested_at = neighbor['pending'].pop(chunk.chunkID, None)
+                        if requested_at is None:
+                            continue  # Chunk đã bị CANCEL / CHOKE hoặc không được yêu cầu
+                        neighbor['timeouts'] = 0
+                        if self.peer.bitField[chunk.chunkID]:
+                            # Endgame: bản sao tới cùng lúc với bản từ peer khác
+                            self._request_done(chunk.chunkID)
+                            self.condition.notify_all()
+                            continue
+                    self.metrics.inc('bytes_in', len(payload), peer=neighbor['name'])
+                    self.metrics.observe('chunk_latency', time.monotonic() - requested_at)
+                    valid = self.peer.manifest.verify_chunk(chunk)
+                    written_at = time.perf_counter()
+                    self.metrics.observe('hash_time', written_at - received_at)
+                    if not valid:
+                        # Chunk hỏng: tải lại từ peer khác
+                        self.metrics.inc('chunks_corrupted')
+                        logger.warning("Chunk %d from %s failed verification.", chunk.chunkID, neighbor['name'])
+                        self._release_chunk(neighbor, chunk.chunkID, lost=True)
+                        badChunks += 1
+                        if badChunks >= MAX_BAD_CHUNKS:
+                            raise ConnectionError("too many corrupted chunks")
+                        continue
+                    # Ghi chunk vào file trước khi đánh dấu đã có, để server không gửi dữ liệu chưa ghi
+                    try:
+                        self.peer.file.write_chunk(chunk.chunkID, chunk.data)
+                    except OSError:
+                        self._release_chunk(neighbor, chunk.chunkID)
+                        raise
+                    self.metrics.observe('write_time', time.perf_counter() - written_at)
+                    self._complete_chunk(neighbor, chunk, requested_at)
+                elif msg_type == PeerProtocol.REJECT:
+                    chunk_index = PeerProtocol.decode_index(payload)
+                    with self.condition:
+                        if neighbor['pending'].pop(chunk_index, None) is None:
+                            continue
+                    self._release_chunk(neighbor, chunk_index, lost=True)
+                elif msg_type == PeerProtocol.HAVE:
+                    self._peer_has(neighbor, PeerProtocol.decode_index(payload))
+                elif msg_type in (PeerProtocol.CHOKE, PeerProtocol.UNCHOKE):
+                    self._set_choked(neighbor, msg_type == PeerProtocol.CHOKE)
+                elif msg_type == PeerProtocol.ERROR:
+                    raise ConnectionError(payload.decode(errors='replace'))
+        except (OSError, struct_error) as e:
+            self._drop_neighbor(neighbor, e)
+
+    def _drop_neighbor(self, neighbor: dict, error: Exception):
+        """Ngắt kết nối neighbor và trả lại các chunk chưa nhận được để neighbor khác tải."""
+        with self.condition:
+            if not self._forget_neighbor(neighbor, error):
+                return
+        self._close(neighbor['conn'])
+
+    def _forget_neighbor(self, neighbor: dict, error: Exception) -> bool:
+        """Đánh dấu neighbor đã mất và trả lại các chunk đang chờ. Phải giữ condition; trả về False nếu đã mất từ trước."""
+        if not neighbor['alive']:
+            return False
+        neighbor['alive'] = False
+        if not self.stopped:
+            logger.warning("Lost peer %s: %s", neighbor['name'], error)
+        for chunk_index in neighbor['pending']:
+            self._request_done(chunk_index)
+        neighbor['pending'].clear()
+        neighbor['score'].record_failure()
+        self.picker.remove_peer(neighbor['bits'])
+        neighbor['bits'] = 0
+        self.condition.notify_all()
+        return True
+
+    def _expire_requests(self):
+        """
+        Cancel the requests that have waited longer than their neighbor's timeout and make
+        their chunks available to other neighbors; the neighbor is not picked for those chunks
+        again while another unchoked neighbor has them. A neighbor that times out MAX_TIMEOUTS
+        times in a row without delivering a chunk is disconnected. Must be called with the
+        condition held.
+        """
+        now = time.monotonic()
+        for neighbor in self.neighbors:
+            if not neighbor['alive'] or not neighbor['pending']:
+                continue
+            deadline = now - self._request_timeout(neighbor)
+            expired = [i for i, requested_at in neighbor['pending'].items() if requested_at < deadline]
+            if not expired:
+                continue
+            for chunk_index in expired:
+                del neighbor['pending'][chunk_index]
+                neighbor['excluded'] |= 1 << chunk_index
+                self._request_done(chunk_index)
+            neighbor['cancels'].extend(expired)
+            neighbor['score'].record_failure()
+            neighbor['timeouts'] += 1
+            self.metrics.inc('requests_timed_out', len(expired))
+            logger.debug("%d requests to %s timed out.", len(expired), neighbor['name'])
+            if neighbor['timeouts'] >= MAX_TIMEOUTS:
+                self._forget_neighbor(neighbor, TimeoutError(f"{neighbor['timeouts']} request timeouts in a row"))
+                self._close(neighbor['conn'])
+            self.condition.notify_all()
+
+    def _request_timeout(self, neighbor: dict) -> float:
+        """Số giây chờ một chunk từ neighbor: vài lần RTT trung bình của nó, hoặc request_timeout nếu chưa đo được."""
+        rtt = neighbor['score'].rtt
+        if rtt is None:
+            return self.request_timeout
+        return max(MIN_REQUEST_TIMEOUT, RTT_TIMEOUT_FACTOR * rtt)
+
+    def _request_done(self, chunk_index: int):
+        """
+        Một request của chunk đã kết thúc (nhận được, thất bại, quá hạn hoặc bị huỷ). Chunk chỉ được
+        trả về picker khi không còn neighbor nào đang chờ nó. Phải giữ condition.
+        """
+        self.outstanding -= 1
+        copies = self.requested.pop(chunk_index, 1) - 1
+        if copies > 0:
+            self.requested[chunk_index] = copies
+        else:
+            self.picker.release(chunk_index)
+
+    @staticmethod
+    def _close(conn: socket.socket):
+        """Đóng kết nối; shutdown trước để thread reader đang chờ recv thoát ra và peer nhận được FIN."""
+        try:
+            conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        conn.close()
+
+    def _acquire_chunks(self, neighbor: dict) -> list:
+        """
+        Pick the rarest needed chunks this neighbor has, up to its free request slots and the
+        global limit. Must be called with the condition held.
+        :return: The picked chunk indices (possibly empty).
+        """
+        batch = []
+        started = time.perf_counter()
+        slots = self._slots(neighbor)
+        now = time.monotonic()
+        bits = self._pickable(neighbor)
+        while len(neighbor['pending']) < slots and self.outstanding < self.max_outstanding:
+            chunk_index = self.picker.pick(bits)
+            if chunk_index is None:
+                if self.peer.totalChunks - self.peer.numDownloaded <= self.endgame_chunks:
+                    batch += self._acquire_endgame(neighbor, bits, slots, now)
+                break
+            neighbor['pending'][chunk_index] = now
+            self.requested[chunk_index] = 1
+            self.outstanding += 1
+            batch.append(chunk_index)
+        if batch:
+            self.metrics.observe('pick_time', time.perf_counter() - started)
+            self.metrics.inc('chunks_requested', len(batch))
+        return batch
+
+    def _acquire_endgame(self, neighbor: dict, bits: int, slots: int, now: float) -> list:
+        """
+        Endgame: every missing chunk is already requested, so request the ones this neighbor
+        has from it too, fewest copies in flight first. Must be called with the condition held.
+        :param bits: The chunks the neighbor may be asked for (see _pickable).
+        """
+        candidates = [i for i in self.picker.missing(bits) if i not in neighbor['pending']]
+        candidates.sort(key=lambda i: self.requested.get(i, 0))
+        batch = []
+        for chunk_index in candidates:
+            if len(neighbor['pending']) >= slots or self.outstanding >= self.max_outstanding:
+                break
+            neighbor['pending'][chunk_index] = now
+            self.requested[chunk_index] = self.requested.get(chunk_index, 0) + 1
+            self.outstanding += 1
+            batch.append(chunk_index)
+        if batch:
+            self.metrics.inc('endgame_requests', len(batch))
+        return batch
+
+    def _pickable(self, neighbor: dict) -> int:
+        """
+        Bitmap of the chunks the neighbor may be asked for: the chunks it has, except those that
+        already timed out on it while another unchoked neighbor has them, so a slow neighbor does
+        not pick the same chunk again right away. Must be called with the condition held.
+        """
+        excluded = neighbor['excluded']
+        if not excluded:
+            return neighbor['bits']
+        others = 0
+        for other in self.neighbors:
+            if other is not neighbor and other['alive'] and not other['choked']:
+                others |= other['bits']
+        return neighbor['bits'] & ~(excluded & others)
+
+    def _slots(self, neighbor: dict) -> int:
+        """
+        Number of requests the neighbor may have in flight: its own window (bandwidth-delay
+        product), capped by its share of max_outstanding in proportion to its score among the
+        unchoked neighbors. Unmeasured neighbors are scored like the best measured one so they
+        get tried. Must be called with the condition held.
+        """
+        window = neighbor['score'].window(self.peer.manifest.chunkSize, self.window, self.max_window)
+        active = [n['score'] for n in self.neighbors if n['alive'] and not n['choked']]
+        best = max((score.score() for score in active if score.throughput is not None), default=0.0)
+        total = sum(score.score(best) for score in active)
+        if total <= 0:
+            return window
+        share = math.ceil(self.max_outstanding * neighbor['score'].score(best) / total)
+        return max(1, min(window, share))
+
+    def _set_choked(self, neighbor: dict, choked: bool):
+        """Xử lý CHOKE / UNCHOKE: khi bị choke, server bỏ qua các request nên trả lại các chunk đang chờ."""
+        with self.condition:
+            neighbor['choked'] = choked
+            if choked:
+                for chunk_index in neighbor['pending']:
+                    self._request_done(chunk_index)
+                neighbor['pending'].clear()
+            else:
+                self.lastProgress = time.monotonic()
+            self.condition.notify_all()
+
+    def _release_chunk(self, neighbor: dict, chunk_index: int, lost: bool = False):
+        """Trả chunk về trạng thái chưa yêu cầu; nếu lost thì neighbor này không còn được coi là có chunk đó."""
+        with self.condition:
+            self._request_done(chunk_index)
+            bit = 1 << chunk_index
+            if lost:
+                neighbor['score'].record_failure()
+                if neighbor['bits'] & bit:
+                    neighbor['bits'] &= ~bit
+                    self.picker.peer_lost(chunk_index)
+            self.condition.notify_all()
+
+    def _peer_has(self, neighbor: dict, chunk_index: int):
+        """Cập nhật khi neighbor thông báo HAVE cho một chunk mới."""
+        if not 0 <= chunk_index < self.peer.totalChunks:
+            return
+        with self.condition:
+            bit = 1 << chunk_index
+            if neighbor['alive'] and not neighbor['bits'] & bit:
+                neighbor['bits'] |= bit
+                self.picker.peer_has(chunk_index)
+                self.lastProgress = time.monotonic()
+                self.condition.notify_all()
+
+    def _complete_chunk(self, neighbor: dict, chunk: FileChunk, requested_at: float):
+        with self.condition:
+            self.picker.complete(chunk.chunkID)
+            self._request_done(chunk.chunkID)
+            if self.requested.pop(chunk.chunkID, None):
+                # Endgame: huỷ các bản sao còn đang chờ trên những neighbor khác
+                for other in self.neighbors:
+                    if other['pending'].pop(chunk.chunkID, None) is not None:
+                        self.outstanding -= 1
+                        other['cancels'].append(chunk.chunkID)
+                        self.metrics.inc('chunks_cancelled')
+            neighbor['score'].record_chunk(chunk.get_size(), requested_at)
+            is_new = self.peer.bitField[chunk.chunkID] == 0
+            if is_new:
+                self.peer.bitField[chunk.chunkID] = 1
+                self.peer.numDownloaded += 1
+                self.lastProgress = time.monotonic()
+                logger.debug("Đã tải thành công mảnh %d từ peer %s", chunk.chunkID, neighbor['name'])
+            self.condition.notify_all()
+        if is_new:
+            self.metrics.inc('chunks_downloaded')
+            # Ghi journal và thông báo HAVE ngoài lock để không chặn các worker khác
+            if self.peer.journal is not None:
+                self.peer.journal.mark(chunk.chunkID)
+            self.peer.notify_have(self.peer.fileID, chunk.chunkID)
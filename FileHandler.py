@@ -1,17 +1,52 @@
 import os
+import mmap
 import hashlib
 import struct
+import threading
+from collections import OrderedDict
+import ChunkHasher
+
+DEFAULT_CACHE_SIZE = 64  # Số chunk tối đa giữ trong LRU cache ở chế độ lazy
+MIN_CHUNK_SIZE = 8192               # Kích thước chunk của các file nhỏ
+MAX_CHUNK_SIZE = 4 * 1024 * 1024    # Kích thước chunk của các file rất lớn
+TARGET_CHUNKS = 1024                # Số chunk tối đa của một file trước khi tăng kích thước chunk
+
+
+def choose_chunk_size(file_size: int) -> int:
+    """
+    Picks the chunk size of a file from its size: the smallest power of two, at least
+    MIN_CHUNK_SIZE, that splits the file into at most TARGET_CHUNKS chunks, capped at
+    MAX_CHUNK_SIZE. Files up to 8 MiB keep 8 KiB chunks, a 256 MiB file gets 256 KiB chunks
+    and files of 4 GiB or more get 4 MiB chunks.
+    :param file_size: Size of the file in bytes.
+    :return: The chunk size in bytes.
+    """
+    chunk_size = MIN_CHUNK_SIZE
+    while chunk_size < MAX_CHUNK_SIZE and chunk_size * TARGET_CHUNKS < file_size:
+        chunk_size *= 2
+    return chunk_size
+
 
 class FileChunk:
-    def __init__(self, chunkID: int, data: bytes):
+    # Không có __dict__: mỗi chunk chỉ gồm ID, dữ liệu và digest 32 bytes
+    __slots__ = ('chunkID', 'data', 'digest')
+
+    def __init__(self, chunkID: int, data: bytes, digest: bytes = None):
         """
         Initialize a FileChunk with a chunkID and the chunk data.
         :param chunkID: The unique ID of the chunk (often its index in the file).
-        :param data: The actual binary data of the chunk.
+        :param data: The actual binary data of the chunk (bytes or a memoryview).
+        :param digest: The already known raw SHA-256 digest of the data; calculated if not given.
         """
         self.chunkID = chunkID
         self.data = data
-        self.chunkHash = self.calculate_hash()  # Store the hash for integrity checking
+        # Store the hash for integrity checking
+        self.digest = digest if digest is not None else hashlib.sha256(data).digest()
+
+    @property
+    def chunkHash(self) -> str:
+        """The hash of the chunk as a hex string."""
+        return self.digest.hex()
 
     def calculate_hash(self) -> str:
         """
@@ -20,13 +55,15 @@ class FileChunk:
         """
         return hashlib.sha256(self.data).hexdigest()
 
-    def verify_integrity(self, expected_hash: str) -> bool:
+    def verify_integrity(self, expected_hash) -> bool:
         """
         Verify the integrity of the chunk by comparing the calculated hash with the expected hash.
-        :param expected_hash: The expected hash value of the chunk.
+        :param expected_hash: The expected hash value of the chunk, raw bytes or a hex string.
         :return: True if the chunk's hash matches the expected hash, False otherwise.
         """
-        return self.chunkHash == expected_hash
+        if isinstance(expected_hash, str):
+            return self.chunkHash == expected_hash
+        return self.digest == expected_hash
 
     def get_size(self) -> int:
         """
@@ -57,24 +94,126 @@ class FileChunk:
         return FileChunk(chunkID, data)
 
 
+class Manifest:
+    # Header: [fileSize (8 bytes)] + [chunkSize (4 bytes)] + [chunkCount (4 bytes)]
+    HEADER = struct.Struct('!QII')
+
+    def __init__(self, file_size: int, chunk_size: int, chunk_count: int, digests: bytes):
+        """
+        Initialize a Manifest describing a shared file.
+        :param file_size: Size of the file in bytes.
+        :param chunk_size: Size of each chunk in bytes.
+        :param chunk_count: Number of chunks in the file.
+        :param digests: The raw SHA-256 digests of all chunks, concatenated in chunk order.
+        """
+        if len(digests) != chunk_count * ChunkHasher.DIGEST_SIZE:
+            raise ValueError("Manifest digests do not match the chunk count.")
+        if chunk_size <= 0 or chunk_count != (file_size + chunk_size - 1) // chunk_size:
+            raise ValueError("Manifest chunk count does not match the file size.")
+        self.fileSize = file_size
+        self.chunkSize = chunk_size
+        self.chunkCount = chunk_count
+        self.digests = digests
+
+    def to_bytes(self) -> bytes:
+        """
+        Convert the Manifest to bytes.
+        The format will be: [header (16 bytes)] + [chunkCount * 32 bytes of digests]
+        """
+        return self.HEADER.pack(self.fileSize, self.chunkSize, self.chunkCount) + self.digests
+
+    @staticmethod
+    def from_bytes(byte_data: bytes):
+        """
+        Decode a bytes object produced by to_bytes back into a Manifest.
+        :raises ValueError: If the data is truncated or inconsistent.
+        """
+        if len(byte_data) < Manifest.HEADER.size:
+            raise ValueError("Manifest is truncated.")
+        file_size, chunk_size, chunk_count = Manifest.HEADER.unpack_from(byte_data)
+        return Manifest(file_size, chunk_size, chunk_count, bytes(byte_data[Manifest.HEADER.size:]))
+
+    def chunk_digest(self, chunk_id: int) -> bytes:
+        """Returns the expected raw SHA-256 digest of a chunk."""
+        offset = chunk_id * ChunkHasher.DIGEST_SIZE
+        return self.digests[offset:offset + ChunkHasher.DIGEST_SIZE]
+
+    def verify_chunk(self, chunk: FileChunk) -> bool:
+        """
+        Verify a downloaded chunk against the expected digest.
+        :param chunk: The received FileChunk.
+        :return: True if the chunk has the expected size and hash.
+        """
+        if chunk.chunkID < 0 or chunk.chunkID >= self.chunkCount:
+            return False
+        expected_size = min(self.chunkSize, self.fileSize - chunk.chunkID * self.chunkSize)
+        return chunk.get_size() == expected_size and chunk.verify_integrity(self.chunk_digest(chunk.chunkID))
+
+    def file_id(self) -> str:
+        """
+        Compute the fileID this manifest describes, the same way FileHandler does.
+        A downloader can compare it with the requested fileID to authenticate the manifest.
+        """
+        root = ChunkHasher.merkle_root(self.digests).hex()
+        return FileHandler.generate_file_id(self.fileSize, root, self.chunkCount, self.chunkSize)
+
+
 class FileHandler:
-    def __init__(self, file_path: str,  chunk_size: int = 8192):
+    def __init__(self, file_path: str,  chunk_size: int = None, lazy: bool = False,
+                 cache_size: int = DEFAULT_CACHE_SIZE, hash_workers: int = None,
+                 manifest: Manifest = None):
         """
         Initialize the File class with a file path and chunk size.
         :param file_path: Path to the file on the local system.
-        :param chunk_size: Size of each chunk in bytes (default is 8192).
+        :param chunk_size: Size of each chunk in bytes (default: chosen from the file size, see choose_chunk_size).
+        :param lazy: If True, the file is memory-mapped and chunks are created on demand
+                     instead of being loaded into memory.
+        :param cache_size: Maximum number of chunks kept in the LRU cache in lazy mode.
+        :param hash_workers: Number of threads hashing chunks in lazy mode (default: one per core).
+        :param manifest: For a file that is being downloaded: its size, chunk size and chunk
+                         hashes are taken from the manifest and the file is opened for writing
+                         (see create_for_download).
         """
         fileName =  os.path.basename(file_path)
         self.fileName = fileName
         self.filePath = file_path
-        self.fileSize = self.get_file_size()
-        self.fileHash = self.calculate_hash()
-        self.chunkSize = chunk_size
-        self.fileChunks = self.create_file_chunks()
+        self.writable = manifest is not None
+        self.fileSize = manifest.fileSize if self.writable else self.get_file_size()
+        if self.writable:
+            self.chunkSize = manifest.chunkSize
+        elif chunk_size is None:
+            self.chunkSize = choose_chunk_size(self.fileSize)
+        elif chunk_size > 0:
+            self.chunkSize = chunk_size
+        else:
+            raise ValueError(f"Invalid chunk size {chunk_size}.")
+        self.lazy = lazy or self.writable
+        self.fileObj = None
+        self.mmap = None
+        self.cacheSize = cache_size
+        self.chunkCache = OrderedDict()
+        self.cacheLock = threading.Lock()
+        self.writeLock = threading.Lock()
+        # Digest (SHA-256, 32 bytes) của mọi chunk nối liền nhau theo thứ tự chunk, xem chunk_digest
+        if self.writable:
+            self.open()
+            self.fileChunks = None
+            self.digests = manifest.digests
+        elif lazy:
+            # Hash song song từng chunk trên mmap, không đọc toàn bộ file thêm một lần nữa
+            self.open()
+            self.fileChunks = None
+            self.digests = self.hash_chunks(hash_workers)
+        else:
+            self.fileChunks = self.create_file_chunks()
+            self.digests = b''.join(chunk.digest for chunk in self.fileChunks)
+        # fileHash là Merkle root của hash các chunk
+        self.fileHash = ChunkHasher.merkle_root(self.digests).hex()
         self.totalChunks = self.getTotalChunks()
         self.fileID = self.generate_file_id(self.fileSize, self.fileHash, self.totalChunks, self.chunkSize)
 
-    def generate_file_id(self, size, hashCode, numChunks, chunkSize) -> str:
+    @staticmethod
+    def generate_file_id(size, hashCode, numChunks, chunkSize) -> str:
         """
         Tạo ra fileID bằng cách kết hợp metadata như fileSize và fileHash.
         :return: Chuỗi fileID duy nhất.
@@ -118,6 +257,47 @@ class FileHandler:
         chunks.sort(key=lambda chunk: chunk.chunkID)
         return chunks
 
+    def hash_chunks(self, workers: int = None) -> bytes:
+        """
+        Hashes every chunk of the memory-mapped file using a thread pool.
+        :param workers: Number of hashing threads (default: one per core).
+        :return: The raw SHA-256 digests of every chunk, concatenated in chunk order.
+        """
+        if self.mmap is None:
+            return b''
+        view = memoryview(self.mmap)
+        try:
+            return ChunkHasher.hash_chunks(view, self.chunkSize, workers)
+        finally:
+            view.release()
+
+    def chunk_digest(self, chunk_id: int) -> bytes:
+        """Returns the raw SHA-256 digest of a chunk."""
+        offset = chunk_id * ChunkHasher.DIGEST_SIZE
+        return self.digests[offset:offset + ChunkHasher.DIGEST_SIZE]
+
+    def verify_chunks(self, chunk_ids: list, workers: int = None) -> list:
+        """
+        Re-hashes chunks already on disk (in parallel) and checks them against the expected digests.
+        :param chunk_ids: The chunks to verify.
+        :param workers: Number of hashing threads (default: one per core).
+        :return: The chunk IDs whose data matches the expected hash.
+        """
+        self.open()
+        if self.mmap is None or not chunk_ids:
+            return []
+        view = memoryview(self.mmap)
+        try:
+            digests = ChunkHasher.hash_selected(view, self.chunkSize, chunk_ids, workers)
+        finally:
+            view.release()
+        return [chunk_id for chunk_id, digest in zip(chunk_ids, digests)
+                if digest == self.chunk_digest(chunk_id)]
+
+    def get_manifest(self) -> Manifest:
+        """Returns the Manifest (size, chunk size, chunk count and chunk digests) of the file."""
+        return Manifest(self.fileSize, self.chunkSize, self.totalChunks, bytes(self.digests))
+
     def get_metadata(self) -> dict:
         """Returns metadata of the file including name, ID, size, and hash."""
         return {
@@ -130,18 +310,123 @@ class FileHandler:
     def get_chunk(self, chunk_id: int) -> FileChunk:
         """
         Retrieves a specific file chunk by its ID.
+        In lazy mode the chunk is a memoryview over the mmap, created on demand and
+        kept in a bounded LRU cache.
         :param chunk_id: The ID of the chunk to retrieve.
         :return: The FileChunk object if it exists, otherwise raises IndexError.
         """
-        if chunk_id < 0 or chunk_id >= len(self.fileChunks):
+        if chunk_id < 0 or chunk_id >= self.totalChunks:
             raise IndexError(f"Chunk ID {chunk_id} is out of range.")
-        return self.fileChunks[chunk_id]
+        if not self.lazy:
+            return self.fileChunks[chunk_id]
+        with self.cacheLock:
+            chunk = self.chunkCache.get(chunk_id)
+            if chunk is not None:
+                self.chunkCache.move_to_end(chunk_id)
+                return chunk
+            if self.mmap is None:
+                self.open()
+            offset, length = self.chunk_range(chunk_id)
+            chunk = FileChunk(chunk_id, memoryview(self.mmap)[offset:offset + length], self.chunk_digest(chunk_id))
+            self.chunkCache[chunk_id] = chunk
+            if len(self.chunkCache) > self.cacheSize:
+                self.chunkCache.popitem(last=False)
+            return chunk
+
+    def chunk_range(self, chunk_id: int) -> tuple:
+        """
+        Returns the position of a chunk inside the file.
+        :param chunk_id: The ID of the chunk.
+        :return: An (offset, length) tuple in bytes.
+        """
+        offset = chunk_id * self.chunkSize
+        return offset, min(self.chunkSize, self.fileSize - offset)
+
+    def open(self):
+        """
+        Opens the file for serving and keeps the file object in self.fileObj.
+        Chunks can then be streamed with os.sendfile using chunk_range offsets.
+        In lazy mode the file is also memory-mapped (read-only).
+        :return: The open binary file object.
+        """
+        if self.fileObj is None:
+            try:
+                self.fileObj = open(self.filePath, 'r+b' if self.writable else 'rb')
+            except OSError:
+                raise FileNotFoundError(f"Unable to open file: {self.filePath}")
+        if self.lazy and self.mmap is None and self.fileSize > 0:
+            self.mmap = mmap.mmap(self.fileObj.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.fileObj
+
+    @classmethod
+    def create_for_download(cls, file_path: str, manifest: Manifest):
+        """
+        Preallocates the output file of a download and opens it for writing chunks at their offsets.
+        An existing file is kept (only resized), so a partially written file can be reused.
+        :param file_path: Path of the output file.
+        :param manifest: The Manifest of the file being downloaded.
+        :return: A writable, lazy FileHandler.
+        """
+        try:
+            with open(file_path, 'ab') as f:
+                f.truncate(manifest.fileSize)
+        except OSError:
+            raise FileNotFoundError(f"Unable to create file: {file_path}")
+        return cls(file_path, manifest.chunkSize, lazy=True, manifest=manifest)
+
+    def write_chunk(self, chunk_id: int, data: bytes):
+        """
+        Writes a chunk directly at its offset in the file opened by create_for_download.
+        :param chunk_id: The ID of the chunk.
+        :param data: The chunk data.
+        """
+        if not self.writable:
+            raise PermissionError(f"File is not open for writing: {self.filePath}")
+        offset, length = self.chunk_range(chunk_id)
+        if len(data) != length:
+            raise ValueError(f"Chunk {chunk_id} must be {length} bytes, got {len(data)}.")
+        fd = self.open().fileno()
+        if hasattr(os, 'pwrite'):
+            view = memoryview(data)
+            written = 0
+            while written < length:
+                written += os.pwrite(fd, view[written:], offset + written)
+        else:
+            # Windows không có os.pwrite
+            with self.writeLock:
+                self.fileObj.seek(offset)
+                self.fileObj.write(data)
+                self.fileObj.flush()
+
+    def flush(self):
+        """Flushes the written chunks to disk."""
+        if self.fileObj is not None and self.writable:
+            self.fileObj.flush()
+            os.fsync(self.fileObj.fileno())
+
+    def close(self):
+        """Closes the file object and the mmap opened by open()."""
+        with self.cacheLock:
+            self.chunkCache.clear()
+        if self.mmap is not None:
+            try:
+                self.mmap.close()
+            except BufferError:
+                pass  # Vẫn còn chunk đang được dùng; mmap sẽ được giải phóng khi chúng bị thu hồi
+            self.mmap = None
+        if self.fileObj is not None:
+            self.fileObj.close()
+            self.fileObj = None
 
     def get_all_chunks(self) -> list:
         """Returns a list of all file chunks."""
+        if self.lazy:
+            return [self.get_chunk(i) for i in range(self.totalChunks)]
         return self.fileChunks
 
     def getTotalChunks(self):
+        if self.lazy:
+            return (self.fileSize + self.chunkSize - 1) // self.chunkSize
         return len(self.fileChunks)
 
     @staticmethod
@@ -0,0 +1,174 @@
+import io
+import time
+import pstats
+import cProfile
+import threading
+import tracemalloc
+
+HISTOGRAM_BUCKETS = 32  # Bucket i chứa các giá trị trong [2^(i-1), 2^i) micro giây; bucket cuối không giới hạn
+
+
+class Histogram:
+    __slots__ = ('count', 'total', 'max', 'buckets')
+
+    def __init__(self):
+        """
+        Latency histogram with power-of-two buckets in microseconds.
+        Recording a value is a few integer operations, so it can be used on per-chunk paths;
+        quantiles are approximate (the upper bound of the bucket holding them).
+        """
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * HISTOGRAM_BUCKETS
+
+    def observe(self, seconds: float):
+        """Records one value in seconds."""
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        self.buckets[min(HISTOGRAM_BUCKETS - 1, max(0, int(seconds * 1e6)).bit_length())] += 1
+
+    def quantile(self, q: float) -> float:
+        """Returns an upper bound (in seconds) of the q-quantile of the recorded values."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank:
+                return min(self.max, (1 << index) / 1e6)
+        return self.max
+
+    def snapshot(self) -> dict:
+        return {'count': self.count, 'sum': self.total, 'mean': self.total / self.count if self.count else 0.0,
+                'max': self.max, 'p50': self.quantile(0.5), 'p90': self.quantile(0.9), 'p99': self.quantile(0.99)}
+
+
+class Metrics:
+    def __init__(self):
+        """
+        Counters and latency histograms of one Peer or TrackerServer.
+        Counters can be global (inc(name)) or per remote peer (inc(name, peer='ip:port')).
+        All methods are thread-safe; snapshot() returns a JSON-serializable dict, and the
+        profiling methods turn cProfile (for the calling thread) and tracemalloc on and off
+        while the process is running.
+        """
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.counters = {}
+        self.peerCounters = {}
+        self.histograms = {}
+        self.profiler = None
+
+    def inc(self, name: str, amount: int = 1, peer: str = None):
+        """Adds amount to a counter, or to the counter of one remote peer if peer is given."""
+        with self.lock:
+            if peer is None:
+                self.counters[name] = self.counters.get(name, 0) + amount
+            else:
+                counters = self.peerCounters.setdefault(name, {})
+                counters[peer] = counters.get(peer, 0) + amount
+
+    def observe(self, name: str, seconds: float):
+        """Records a duration in the histogram name."""
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(seconds)
+
+    def snapshot(self, gauges: dict = None) -> dict:
+        """
+        Returns the current values.
+        Rates are averages since start (counter / uptime); diff two snapshots for recent rates.
+        :param gauges: Extra point-in-time values to include (for example open connections).
+        """
+        with self.lock:
+            uptime = time.monotonic() - self.started
+            return {'uptime': uptime,
+                    'counters': dict(self.counters),
+                    'rates': {name: value / uptime for name, value in self.counters.items()} if uptime else {},
+                    'peers': {name: dict(values) for name, values in self.peerCounters.items()},
+                    'histograms': {name: histogram.snapshot() for name, histogram in self.histograms.items()},
+                    'gauges': gauges or {},
+                    'profiling': self.profiler is not None,
+                    'tracemalloc': tracemalloc.is_tracing()}
+
+    def start_profiling(self):
+        """Starts cProfile in the calling thread (for example the event loop of a server)."""
+        if self.profiler is None:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    def stop_profiling(self, limit: int = 40) -> str:
+        """
+        Stops cProfile (must be called from the thread that started it).
+        :return: The top functions by cumulative time, as text.
+        """
+        if self.profiler is None:
+            return ''
+        self.profiler.disable()
+        output = io.StringIO()
+        pstats.Stats(self.profiler, stream=output).sort_stats('cumulative').print_stats(limit)
+        self.profiler = None
+        return output.getvalue()
+
+    @staticmethod
+    def start_tracemalloc(frames: int = 1):
+        """Starts tracing memory allocations of the whole process."""
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+
+    @staticmethod
+    def stop_tracemalloc(limit: int = 20) -> str:
+        """
+        Stops tracing memory allocations.
+        :return: The current and peak traced memory and the lines holding the most memory, as text.
+        """
+        if not tracemalloc.is_tracing():
+            return ''
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        lines = [f"current {current / 1024:.1f} KiB, peak {peak / 1024:.1f} KiB"]
+        lines += [str(stat) for stat in snapshot.statistics('lineno')[:limit]]
+        return '\n'.join(lines) + '\n'
+
+
+class TimedLock:
+    def __init__(self, metrics: Metrics, name: str):
+        """
+        A threading.Lock that records in metrics how long contended acquires waited.
+        Uncontended acquires take the fast path and are not recorded. Usable with `with`
+        and as the lock of a threading.Condition.
+        :param name: Name of the histogram.
+        """
+        self.lock = threading.Lock()
+        self.metrics = metrics
+        self.name = name
+
+    def acquire(self, blocking: bool = True, timeout: float = -1) -> bool:
+        if self.lock.acquire(False):
+            return True
+        if not blocking:
+            return False
+        start = time.perf_counter()
+        acquired = self.lock.acquire(True, timeout)
+        self.metrics.observe(self.name, time.perf_counter() - start)
+        return acquired
+
+    def release(self):
+        self.lock.release()
+
+    def locked(self) -> bool:
+        return self.lock.locked()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
@@ -1,222 +1,785 @@
 import threading
 import socket
-from FileHandler import FileHandler, FileChunk
+import asyncio
+import random
+import hashlib
+import logging
+import time
+import json
+import contextlib
+from collections import deque, OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+import PeerProtocol
+import TrackerProtocol
+from FileHandler import FileHandler, Manifest
+from ResumeJournal import ResumeJournal
+from PiecePicker import bits_from_bitfield, first_missing
+from Downloader import Downloader, DEFAULT_WINDOW, DEFAULT_MAX_OUTSTANDING
+from Metrics import Metrics, TimedLock
 import os
 import struct
-import os
+
+logger = logging.getLogger(__name__)
 # TRACKER_HOST = '20.2.250.184'
-TRACKER_PORT = 5050
-TRACKER_HOST = 'localhost'
+# Địa chỉ tracker mặc định, có thể đổi bằng biến môi trường TRACKER_HOST / TRACKER_PORT
+TRACKER_PORT = int(os.environ.get('TRACKER_PORT', 5050))
+TRACKER_HOST = os.environ.get('TRACKER_HOST', 'localhost')
+PEER_BACKLOG = 1024        # Hàng đợi kết nối của peer server
+PEER_READ_TIMEOUT = 120    # Số giây tối đa chờ message từ một kết nối đang rảnh
+PEER_WRITE_TIMEOUT = 60    # Số giây tối đa chờ một peer nhận dữ liệu
+DEFAULT_MAX_UPLOADS = 4    # Số peer được unchoke (được gửi chunk) cùng lúc
+RECHOKE_INTERVAL = 10      # Số giây giữa hai lần chọn lại các peer được unchoke
+OPTIMISTIC_EVERY = 3       # Đổi peer optimistic unchoke sau mỗi 3 lần chọn lại
+MAX_OPEN_FILES = 256       # Số file đang chia sẻ được giữ mở cùng lúc (các file khác mở lại khi cần)
+ANNOUNCE_INTERVAL = 300    # Chu kỳ announce lại với tracker nếu tracker không trả về chu kỳ khác
+CONNECT_TIMEOUT = 5        # Số giây tối đa chờ kết nối tới một peer
+CONNECT_WORKERS = 16       # Số peer được kết nối song song khi bắt đầu tải
+
 class Peer:
-    def __init__(self, peer_host, peer_port):
+    def __init__(self, peer_host, peer_port, read_timeout: float = PEER_READ_TIMEOUT,
+                 write_timeout: float = PEER_WRITE_TIMEOUT, max_uploads: int = DEFAULT_MAX_UPLOADS,
+                 max_open_files: int = MAX_OPEN_FILES, tracker_host: str = None, tracker_port: int = None):
         self.peerHost = peer_host
         self.peerPort = peer_port
+        self.trackerHost = tracker_host or TRACKER_HOST
+        self.trackerPort = tracker_port or TRACKER_PORT
+        self.metrics = Metrics()         # Bộ đếm và histogram, xem stats()
         self.is_running = False
         self.peer_server_thread = None  # Thêm thuộc tính lưu thread của server
+        self.server_loop = None         # Event loop asyncio của peer server
+        self.server_stop = None
+        self.server_ready = threading.Event()
+        self.server_lock = threading.Lock()  # Tránh hai thread cùng khởi động server / announcer
+        self.server_connections = set()  # Các StreamWriter của kết nối đang mở
+        self.upload_peers = {}           # writer -> trạng thái của các kết nối đã HANDSHAKE (nhận HAVE, choke/unchoke)
+        self.max_uploads = max(1, max_uploads)
+        self.rechoke_round = 0
+        self.optimistic = None           # writer đang được optimistic unchoke
+        self.peer_scores = {}            # (ip, port) -> PeerScore của các peer mình đã tải từ đó
+        self.read_timeout = read_timeout
+        self.write_timeout = write_timeout
+        # Index các file đang chia sẻ trên cùng một server: fileID -> share
+        # (file, bitField, số kết nối đang dùng); chỉ tối đa max_open_files file được mở cùng lúc
+        self.shares = {}
+        self.open_shares = OrderedDict()  # fileID -> share có file đang mở, theo thứ tự dùng gần nhất
+        self.shares_lock = TimedLock(self.metrics, 'shares_lock_wait')
+        self.max_open_files = max(1, max_open_files)
+        self.announce_interval = ANNOUNCE_INTERVAL
+        self.announcer = None            # Thread announce lại định kỳ các file đang chia sẻ
+        self.announce_stop = threading.Event()
         self.fileID = None
-        self.chunks = []
+        self.file = None        # FileHandler của file đang tải trên đĩa
+        self.use_sendfile = True
         self.bitField = None
+        self.manifest = None    # Manifest của file đang tải, dùng để kiểm tra từng chunk
+        self.journal = None     # Journal bitfield trên đĩa để tiếp tục tải khi bị ngắt
         self.totalChunks = 0
+        self.numDownloaded = 0
+        self.downloader = None  # Downloader của lần tải đang chạy
+        self.download_stop = threading.Event()  # Được set bởi stop_download(); người gọi clear trước khi tải lại
 
 
     def start_peer_server(self):
         """Khởi chạy server để lắng nghe các yêu cầu từ peer khác."""
-        if not self.is_running:
-            self.is_running = True
-            self.peer_server_thread = threading.Thread(target=self.peer_server)
-            self.peer_server_thread.start()
+        with self.server_lock:
+            if not self.is_running:
+                self.is_running = True
+                self.server_ready.clear()
+                self.peer_server_thread = threading.Thread(target=self.peer_server)
+                self.peer_server_thread.start()
+                # Chờ server bind xong để peer khác có thể kết nối ngay sau khi đăng ký với tracker
+                self.server_ready.wait()
 
     def stop_peer_server(self):
         """Dừng server P2P khi không cần nữa."""
         if self.is_running:
             self.is_running = False
+            if self.server_loop:
+                self.server_loop.call_soon_threadsafe(self.server_stop.set)
             if self.peer_server_thread:
                 self.peer_server_thread.join()
-            print(f"Peer server at {self.peerHost}:{self.peerPort} has stopped.")
+            self.announce_stop.set()
+            logger.info("Peer server at %s:%s has stopped.", self.peerHost, self.peerPort)
     
     def peer_server(self):
         """Peer server để lắng nghe các yêu cầu download từ các peer khác."""
-        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server_socket.bind(('0.0.0.0', self.peerPort))
-        server_socket.listen(5)
-        print(f"Peer server is running at {self.peerHost}:{self.peerPort}...")
-
-        while self.is_running:
-            conn, addr = server_socket.accept()
-            print(f"Connection from {addr}")
-
-            # Nhận yêu cầu từ peer khác (ví dụ yêu cầu tải file)
-            request = conn.recv(1024).decode()
-            print(f"Received request: {request}")
-            
-            if request.startswith('BITFIELD'):
-                _, fileID = request.split()
-
-                bitfield_message = struct.pack('B' * len(self.bitField), *self.bitField)
-                conn.sendall(bitfield_message)
-            elif request.startswith('GET'):
-                # Giả định request có dạng: "fileID chunk_num"
-                _, fileID, chunk_num = request.split()
-                chunk_num = int(chunk_num)
-                
-                # Kiểm tra xem fileID có trong danh sách chia sẻ và chunk đã được tải chưa
-                if fileID == self.fileID and self.bitField[chunk_num] == 1:
-                    # Nếu chunk đã tải, gửi chunk tương ứng
-                    if self.chunks[chunk_num].chunkID == chunk_num:
-                        conn.sendall(self.chunks[chunk_num].to_bytes())
-                        print(f"Sent chunk {chunk_num} of file {fileID} to {addr}")
+        try:
+            asyncio.run(self.serve())
+        except OSError as e:
+            logger.error("Peer server at %s:%s failed: %s", self.peerHost, self.peerPort, e)
+            self.is_running = False
+        finally:
+            self.server_loop = None
+            self.server_ready.set()
+
+    async def serve(self):
+        """Chạy asyncio server cho tới khi stop_peer_server được gọi."""
+        self.server_stop = asyncio.Event()
+        server = await asyncio.start_server(self.handle_peer_connection, '0.0.0.0', self.peerPort,
+                                            backlog=PEER_BACKLOG)
+        self.server_loop = asyncio.get_running_loop()
+        self.server_ready.set()
+        logger.info("Peer server is running at %s:%s...", self.peerHost, self.peerPort)
+        rechoker = asyncio.create_task(self.rechoke_loop())
+        await self.server_stop.wait()
+        rechoker.cancel()
+        server.close()
+        # Đóng các kết nối còn mở để các handler kết thúc
+        for writer in list(self.server_connections):
+            writer.transport.abort()
+        await server.wait_closed()
+
+    async def handle_peer_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Xử lý một kết nối peer-wire: nhận nhiều request trên cùng một kết nối cho tới khi peer đóng."""
+        addr = writer.get_extra_info('peername')
+        logger.debug("Connection from %s", addr)
+        self.metrics.inc('connections')
+        self.server_connections.add(writer)
+        outbox = deque()  # Các chunk (int) hoặc message (bytes) đang chờ gửi
+        wakeup = asyncio.Event()
+        connection = {'outbox': outbox, 'wakeup': wakeup, 'share': None, 'remote': None, 'choked': True, 'interested': False,
+                      'uploaded': 0, 'lastUploaded': 0, 'lastReceived': 0, 'uploadRate': 0.0, 'downloadRate': 0.0,
+                      'name': f"{addr[0]}:{addr[1]}"}
+        sender = asyncio.create_task(self.send_loop(writer, connection))
+        try:
+            while True:
+                try:
+                    msg_type, payload = await PeerProtocol.read_message(reader, self.read_timeout)
+                except asyncio.TimeoutError:
+                    if outbox:
+                        continue  # Peer vẫn đang chờ dữ liệu từ mình
+                    logger.debug("Connection from %s timed out.", addr)
+                    return
+
+                if msg_type == PeerProtocol.HANDSHAKE:
+                    fileID, _, listen_port = payload.decode().partition(' ')
+                    share = self.open_share(fileID) if connection['share'] is None else None
+                    if share is None:
+                        outbox.append(PeerProtocol.encode_message(PeerProtocol.ERROR, b"File not shared."))
                     else:
-                        print("Some thing error")
+                        connection['share'] = share
+                        # Gửi bitfield 8 chunk/byte, sau đó gửi HAVE mỗi khi tải xong một chunk mới
+                        bitField = share['bitField']
+                        outbox.append(PeerProtocol.encode_bitfield(bits_from_bitfield(bitField), len(bitField)))
+                        if listen_port.isdigit():
+                            # Địa chỉ peer server của bên kia, để biết mình đã tải được bao nhiêu từ họ
+                            connection['remote'] = (addr[0], int(listen_port))
+                            connection['name'] = f"{addr[0]}:{listen_port}"
+                            score = self.peer_scores.get(connection['remote'])
+                            connection['lastReceived'] = score.bytes if score else 0
+                        self.upload_peers[writer] = connection
+                elif msg_type == PeerProtocol.REQUEST:
+                    self.metrics.inc('requests_received')
+                    if not connection['choked']:
+                        outbox.append(PeerProtocol.decode_index(payload))
+                    # Request tới khi đang choke bị bỏ qua: bên tải trả lại các chunk đó khi nhận CHOKE
+                elif msg_type == PeerProtocol.INTERESTED:
+                    connection['interested'] = True
+                    if writer in self.upload_peers:
+                        self.fill_upload_slots()
+                elif msg_type == PeerProtocol.NOT_INTERESTED:
+                    connection['interested'] = False
+                    if not connection['choked']:
+                        self.set_choked(connection, True)
+                        self.fill_upload_slots()
+                elif msg_type == PeerProtocol.CANCEL:
+                    chunk_num = PeerProtocol.decode_index(payload)
+                    if chunk_num in outbox:
+                        outbox.remove(chunk_num)
+                elif msg_type == PeerProtocol.HAVE:
+                    pass  # Server không cần biết các mảnh mà peer bên kia vừa tải xong
                 else:
-                    # Nếu chunk chưa được tải hoặc file không có, báo lỗi
-                    conn.sendall(b"Chunk not available or file not shared.")
-            
-            conn.close()
-
-    def share_file(self, filePath):
-        """Bắt đầu chia sẻ file và mở server nếu cần."""
-
-        file = FileHandler(filePath)
-        self.fileID = file.fileID
-        self.chunks = file.fileChunks
-        self.bitField = [1] * file.getTotalChunks()
-        fileName = os.path.basename(filePath) 
+                    outbox.append(PeerProtocol.encode_message(PeerProtocol.ERROR, b"Invalid request."))
+                wakeup.set()
+        except (OSError, EOFError, ValueError, struct.error) as e:
+            # ValueError: HANDSHAKE không phải UTF-8 (UnicodeDecodeError) hoặc cổng không hợp lệ
+            logger.debug("Connection from %s closed: %s", addr, e)
+        finally:
+            sender.cancel()
+            if self.upload_peers.pop(writer, None) is not None and not connection['choked']:
+                self.fill_upload_slots()
+            if self.optimistic is writer:
+                self.optimistic = None
+            if connection['share'] is not None:
+                self.release_share(connection['share'])
+            self.server_connections.discard(writer)
+            writer.close()
+
+    def add_share(self, file: FileHandler, bitField: bytearray = None, pinned: bool = False) -> dict:
+        """
+        Thêm file vào index các file đang chia sẻ (thay thế share cũ cùng fileID nếu có).
+        bitField: các chunk đang có, mặc định là đủ mọi chunk; pinned: không bao giờ đóng file (file đang tải).
+        """
+        share = {'fileID': file.fileID, 'name': file.fileName, 'file': file,
+                 'bitField': bytearray(b'\x01') * file.totalChunks if bitField is None else bitField,
+                 'connections': 0, 'pinned': pinned, 'removed': False, 'announced': False}
+        with self.shares_lock:
+            old = self.shares.get(file.fileID)
+            self.shares[file.fileID] = share
+            self.open_shares.pop(file.fileID, None)
+            if file.fileObj is not None:
+                self.open_shares[file.fileID] = share
+                self.evict_open_files()
+        if old is not None and old is not share:
+            self.call_in_server(self.close_share, old)
+        return share
+
+    def remove_share(self, fileID: str) -> bool:
+        """Ngừng chia sẻ fileID: xoá khỏi index, ngắt các kết nối đang tải file đó và đóng file."""
+        with self.shares_lock:
+            share = self.shares.pop(fileID, None)
+            self.open_shares.pop(fileID, None)
+        if share is None:
+            return False
+        self.call_in_server(self.close_share, share)
+        return True
+
+    def open_share(self, fileID: str):
+        """Tìm share của fileID cho một kết nối mới và mở file nếu cần. Trả về None nếu không chia sẻ file này."""
+        with self.shares_lock:
+            share = self.shares.get(fileID)
+            if share is None:
+                return None
+            try:
+                share['file'].open()
+            except OSError as e:
+                logger.warning("Unable to open shared file %s: %s", share['name'], e)
+                return None
+            share['connections'] += 1
+            self.open_shares[fileID] = share
+            self.open_shares.move_to_end(fileID)
+            self.evict_open_files()
+            return share
+
+    def release_share(self, share: dict):
+        """Một kết nối ngừng dùng share; đóng file nếu share đã bị xoá và không còn ai dùng."""
+        with self.shares_lock:
+            share['connections'] -= 1
+            if share['removed'] and share['connections'] == 0:
+                share['file'].close()
+            else:
+                self.evict_open_files()
+
+    def evict_open_files(self):
+        """Đóng các file ít dùng gần đây nhất khi có quá max_open_files file mở (gọi khi đang giữ shares_lock)."""
+        for fileID in list(self.open_shares):
+            if len(self.open_shares) <= self.max_open_files:
+                break
+            share = self.open_shares[fileID]
+            if share['connections'] or share['pinned']:
+                continue
+            del self.open_shares[fileID]
+            share['file'].close()
+
+    def close_share(self, share: dict):
+        """Ngắt các kết nối đang dùng một share đã bị xoá (chạy trong event loop của server nếu có)."""
+        with self.shares_lock:
+            share['removed'] = True
+            if share['connections'] == 0:
+                share['file'].close()
+        for writer, connection in list(self.upload_peers.items()):
+            if connection['share'] is share:
+                writer.transport.abort()
+
+    def call_in_server(self, callback, *args):
+        """Chạy callback trong event loop của peer server (gọi từ thread bất kỳ), hoặc chạy ngay nếu server không chạy."""
+        loop = self.server_loop
+        if loop is not None:
+            try:
+                loop.call_soon_threadsafe(callback, *args)
+                return
+            except RuntimeError:
+                pass  # Server vừa dừng
+        callback(*args)
+
+    def run_in_server(self, callback, *args):
+        """Như call_in_server nhưng chờ callback chạy xong và trả về kết quả của nó."""
+        loop = self.server_loop
+        if loop is None:
+            return callback(*args)
+        future = Future()
+
+        def run():
+            try:
+                future.set_result(callback(*args))
+            except Exception as e:
+                future.set_exception(e)
+        loop.call_soon_threadsafe(run)
+        return future.result()
+
+    def stats(self) -> dict:
+        """Số liệu hiện tại của peer: bộ đếm (byte gửi/nhận theo từng peer...), histogram độ trễ và trạng thái server."""
+        with self.shares_lock:
+            gauges = {'shares': len(self.shares), 'open_files': len(self.open_shares)}
+        gauges.update({'connections': len(self.server_connections), 'upload_peers': len(self.upload_peers),
+                       'unchoked': sum(1 for connection in list(self.upload_peers.values()) if not connection['choked'])})
+        return self.metrics.snapshot(gauges)
+
+    def start_profiling(self):
+        """Bật cProfile cho event loop của peer server (hoặc thread hiện tại nếu server không chạy)."""
+        self.run_in_server(self.metrics.start_profiling)
+
+    def stop_profiling(self, limit: int = 40) -> str:
+        """Tắt cProfile đã bật bằng start_profiling; trả về các hàm tốn thời gian nhất."""
+        return self.run_in_server(self.metrics.stop_profiling, limit)
+
+    def tracker_stats(self) -> dict:
+        """Lấy số liệu của Tracker Server (request STATS)."""
+        return json.loads(self.tracker_request("STATS", read_reply=TrackerProtocol.read_blob))
+
+    def notify_have(self, fileID: str, chunk_num: int):
+        """Thông báo HAVE cho mọi peer đang kết nối khi vừa tải xong một chunk (gọi từ thread bất kỳ)."""
+        if self.server_loop is not None:
+            self.call_in_server(self.broadcast_have, fileID, chunk_num)
+
+    def broadcast_have(self, fileID: str, chunk_num: int):
+        """Đưa message HAVE vào outbox của từng kết nối đang tải fileID (chạy trong event loop của server)."""
+        message = PeerProtocol.encode_index(PeerProtocol.HAVE, chunk_num)
+        for connection in self.upload_peers.values():
+            if connection['share']['fileID'] == fileID:
+                connection['outbox'].append(message)
+                connection['wakeup'].set()
+
+    def set_choked(self, connection: dict, choked: bool):
+        """Gửi CHOKE / UNCHOKE cho một kết nối; khi choke thì bỏ các chunk chưa gửi trong outbox."""
+        if connection['choked'] == choked:
+            return
+        connection['choked'] = choked
+        outbox = connection['outbox']
+        if choked:
+            messages = [item for item in outbox if not isinstance(item, int)]
+            outbox.clear()
+            outbox.extend(messages)
+        outbox.append(PeerProtocol.encode_message(PeerProtocol.CHOKE if choked else PeerProtocol.UNCHOKE))
+        connection['wakeup'].set()
+
+    def upload_rank(self, writer) -> tuple:
+        """Tit-for-tat: ưu tiên peer gửi cho mình nhanh nhất, sau đó tới peer nhận của mình nhanh nhất."""
+        connection = self.upload_peers[writer]
+        return connection['downloadRate'], connection['uploadRate']
+
+    def fill_upload_slots(self):
+        """Unchoke các peer interested tốt nhất đang chờ, cho tới khi đủ max_uploads peer."""
+        unchoked = sum(1 for connection in self.upload_peers.values() if not connection['choked'])
+        if unchoked >= self.max_uploads:
+            return
+        waiting = [writer for writer, connection in self.upload_peers.items()
+                   if connection['choked'] and connection['interested']]
+        waiting.sort(key=self.upload_rank, reverse=True)
+        for writer in waiting[:self.max_uploads - unchoked]:
+            self.set_choked(self.upload_peers[writer], False)
+
+    def rechoke(self):
+        """
+        Chọn lại các peer được unchoke: max_uploads - 1 peer interested có upload_rank cao nhất,
+        cộng một peer optimistic chọn ngẫu nhiên (đổi sau mỗi OPTIMISTIC_EVERY lần) để thử peer mới.
+        """
+        self.rechoke_round += 1
+        for connection in self.upload_peers.values():
+            score = self.peer_scores.get(connection['remote'])
+            received = score.bytes if score else 0
+            connection['downloadRate'] = (received - connection['lastReceived']) / RECHOKE_INTERVAL
+            connection['uploadRate'] = (connection['uploaded'] - connection['lastUploaded']) / RECHOKE_INTERVAL
+            connection['lastReceived'] = received
+            connection['lastUploaded'] = connection['uploaded']
+
+        interested = [writer for writer, connection in self.upload_peers.items() if connection['interested']]
+        interested.sort(key=self.upload_rank, reverse=True)
+        unchoke = set(interested[:self.max_uploads - 1])
+        others = interested[self.max_uploads - 1:]
+        if self.optimistic not in others or self.rechoke_round % OPTIMISTIC_EVERY == 0:
+            self.optimistic = random.choice(others) if others else None
+        if self.optimistic is not None:
+            unchoke.add(self.optimistic)
+        for writer, connection in self.upload_peers.items():
+            self.set_choked(connection, writer not in unchoke)
+
+    async def rechoke_loop(self):
+        """Chạy rechoke định kỳ trong event loop của server."""
+        while True:
+            await asyncio.sleep(RECHOKE_INTERVAL)
+            self.rechoke()
+
+    async def send_loop(self, writer: asyncio.StreamWriter, connection: dict):
+        """Gửi lần lượt các message trong outbox; chỉ task này được ghi vào kết nối."""
+        outbox = connection['outbox']
+        wakeup = connection['wakeup']
+        try:
+            while True:
+                if not outbox:
+                    wakeup.clear()
+                    await wakeup.wait()
+                    continue
+                item = outbox.popleft()
+                if isinstance(item, int):
+                    started = time.perf_counter()
+                    sent = await self.send_chunk(writer, connection['share'], item)
+                    await asyncio.wait_for(writer.drain(), self.write_timeout)
+                    connection['uploaded'] += sent
+                    if sent:
+                        self.metrics.inc('bytes_out', sent, peer=connection['name'])
+                        self.metrics.observe('upload_time', time.perf_counter() - started)
+                    else:
+                        self.metrics.inc('chunks_rejected')
+                    continue
+                writer.write(item)
+                await asyncio.wait_for(writer.drain(), self.write_timeout)
+        except (BrokenPipeError, ConnectionResetError) as e:
+            # Peer đã ngắt kết nối (ví dụ tải xong hoặc tạm dừng): bình thường, không cần cảnh báo
+            logger.debug("Connection to %s lost while sending: %r", writer.get_extra_info('peername'), e)
+            writer.transport.abort()
+        except (OSError, asyncio.TimeoutError) as e:
+            # Peer không nhận dữ liệu nữa: đóng kết nối để vòng đọc cũng kết thúc
+            logger.warning("Failed to send to %s: %r", writer.get_extra_info('peername'), e)
+            writer.transport.abort()
+
+    async def send_chunk(self, writer: asyncio.StreamWriter, share: dict, chunk_num: int) -> int:
+        """Gửi một chunk của share cho peer mà không copy dữ liệu, hoặc REJECT nếu chunk chưa có. Trả về số byte dữ liệu đã gửi."""
+        # Kiểm tra xem chunk đã được tải chưa
+        bitField = share['bitField']
+        if not (0 <= chunk_num < len(bitField) and bitField[chunk_num] == 1):
+            # Nếu chunk chưa được tải, báo lỗi
+            writer.write(PeerProtocol.encode_index(PeerProtocol.REJECT, chunk_num))
+            return 0
+
+        # File (đang seed hoặc đang tải) nằm trên đĩa: chỉ giữ file descriptor và offset, dùng os.sendfile
+        file = share['file']
+        offset, length = file.chunk_range(chunk_num)
+        writer.write(PeerProtocol.piece_header(chunk_num, length))
+        if self.use_sendfile:
+            if writer.is_closing():
+                raise ConnectionResetError("Connection lost")
+            loop = asyncio.get_running_loop()
+            try:
+                sent = await asyncio.wait_for(
+                    loop.sendfile(writer.transport, file.fileObj, offset, length, fallback=False),
+                    self.write_timeout)
+            except asyncio.SendfileNotAvailableError:
+                self.use_sendfile = False  # Ví dụ: SSL hoặc event loop không hỗ trợ
+            except RuntimeError as e:
+                # "Transport is closing": peer ngắt kết nối giữa lúc đang gửi
+                raise ConnectionResetError(str(e)) from e
+            else:
+                if sent != length:
+                    raise OSError(f"File changed while sending chunk {chunk_num}.")
+                return length
+        writer.write(file.get_chunk(chunk_num).data)
+        return length
+
+    def share_file(self, filePath, chunk_size: int = None) -> str:
+        """Bắt đầu chia sẻ file (thêm vào index của server, có thể chia sẻ nhiều file cùng lúc) và mở server nếu cần.
+
+        chunk_size: kích thước chunk (mặc định chọn theo kích thước file, xem FileHandler.choose_chunk_size).
+        Trả về fileID của file.
+        """
+        return self.share_files([filePath], chunk_size)[0]
+
+    def share_files(self, filePaths: list, chunk_size: int = None) -> list:
+        """Chia sẻ nhiều file cùng lúc: mọi manifest và một ANNOUNCE theo lô được gửi trên cùng một kết nối tracker.
+
+        chunk_size: như share_file. Trả về danh sách fileID theo thứ tự của filePaths.
+        """
+        files = [FileHandler(filePath, chunk_size, lazy=True) for filePath in filePaths]
+        shares = [self.add_share(file) for file in files]
         # Khởi động server P2P nếu chưa chạy
         self.start_peer_server()
 
-        client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        with self.tracker_connection() as connection:
+            # Đăng manifest để người tải kiểm tra được từng chunk
+            for file in files:
+                self.publish_manifest(file, connection)
+            # Đăng ký chia sẻ các file với Tracker Server, sau đó announce lại định kỳ để không bị xoá
+            self.announce(shares, connection)
+        for share in shares:
+            share['announced'] = True
+        self.start_announcer()
+        return [file.fileID for file in files]
+
+    def seed_file(self, file: FileHandler) -> dict:
+        """Chia sẻ tiếp một file đã có FileHandler (ví dụ file vừa được Peer khác tải xong) mà không băm lại file."""
+        share = self.add_share(file)
+        self.start_peer_server()
+        share['announced'] = True
+        self.announce([share])
+        self.start_announcer()
+        return share
+
+    def announce(self, shares: list, connection=None):
+        """Đăng ký (hoặc gia hạn) các share với Tracker Server, mỗi lô tối đa MAX_BATCH file trong một request ANNOUNCE.
+
+        Share chưa đủ chunk được announce là leecher, share đủ chunk là seeder. Nếu tracker báo chưa có
+        manifest của một file (ví dụ tracker vừa khởi động lại và không lưu trạng thái), manifest được gửi lại.
+        connection: kết nối tracker đang mở (xem tracker_connection); mặc định mở một kết nối cho mọi lô.
+        """
+        if connection is None:
+            with self.tracker_connection() as connection:
+                return self.announce(shares, connection)
+        for start in range(0, len(shares), TrackerProtocol.MAX_BATCH):
+            batch = shares[start:start + TrackerProtocol.MAX_BATCH]
+            body = ''.join(f"{share['fileID']} {share['file'].totalChunks} {share['bitField'].count(0)} {share['name']}\n"
+                           for share in batch)
+            response, missing = self.tracker_request(f"ANNOUNCE {self.peerHost} {self.peerPort} {len(batch)}",
+                                                     body.encode(), TrackerProtocol.read_announce, connection)
+            logger.debug("Response from server: %s", response)
+            if missing:
+                by_id = {share['fileID']: share for share in batch}
+                for fileID in missing:
+                    share = by_id.get(fileID)
+                    if share is not None:
+                        logger.info("Tracker has no manifest for %s, publishing it again.", share['name'])
+                        self.publish_manifest(share['file'], connection)
+            # Tracker trả về chu kỳ announce ở cuối phản hồi: "... Interval <giây>"
+            _, _, interval = response.rpartition(' Interval ')
+            if interval:
+                self.announce_interval = float(interval)
+
+    def try_announce(self, shares: list):
+        """Như announce nhưng chỉ in lỗi nếu không liên lạc được với tracker (sẽ thử lại ở lần announce sau)."""
         try:
-            # Kết nối tới Tracker Server
-            client_socket.connect((TRACKER_HOST, TRACKER_PORT))
-            
-            # Tạo request đăng ký chia sẻ file với Tracker Server
-            request = f"POST {fileName} {file.fileID} {file.getTotalChunks()} {self.peerHost} {self.peerPort}"
-            print(request)
-            # Gửi request
-            client_socket.sendall(request.encode())
-            
-            # Nhận phản hồi từ server
-            response = client_socket.recv(8192).decode()
-            print("Response from server:", response)
-        
-        finally:
-            # Đóng kết nối
-            client_socket.close()
+            self.announce(shares)
+        except (OSError, ValueError) as e:
+            logger.warning("Announce to tracker failed: %s", e)
+
+    def scrape(self, fileIDs: list) -> dict:
+        """Lấy số seeder và leecher của nhiều fileID mà không cần tải danh sách peer.
+
+        Trả về dict fileID -> (số seeder, số leecher).
+        """
+        fileIDs = list(fileIDs)
+        counts = {}
+        with self.tracker_connection() as connection:
+            for start in range(0, len(fileIDs), TrackerProtocol.MAX_BATCH):
+                batch = fileIDs[start:start + TrackerProtocol.MAX_BATCH]
+                body = ''.join(f"{fileID}\n" for fileID in batch).encode()
+                counts.update(zip(batch, self.tracker_request(f"SCRAPE {len(batch)}", body,
+                                                              TrackerProtocol.read_scrape, connection)))
+        return counts
+
+    def start_announcer(self):
+        """Khởi chạy thread announce lại định kỳ các file đang chia sẻ (nếu chưa chạy)."""
+        with self.server_lock:
+            if self.announcer is None or not self.announcer.is_alive():
+                self.announce_stop.clear()
+                self.announcer = threading.Thread(target=self.announce_loop, daemon=True)
+                self.announcer.start()
+
+    def announce_loop(self):
+        """Announce lại mọi file đang chia sẻ sau mỗi chu kỳ announce cho tới khi peer server dừng."""
+        while not self.announce_stop.wait(self.announce_interval):
+            with self.shares_lock:
+                shares = [share for share in self.shares.values() if share['announced']]
+            if shares:
+                self.try_announce(shares)
+
+    def unshare_file(self, fileID: str) -> bool:
+        """Ngừng chia sẻ một file và xoá peer này khỏi danh sách của file trên Tracker Server."""
+        if not self.remove_share(fileID):
+            return False
+        response = self.tracker_request(f"DELETE {fileID} {self.peerHost} {self.peerPort}")
+        logger.debug("Response from server: %s", response)
+        return True
+
+    @contextlib.contextmanager
+    def tracker_connection(self):
+        """Mở một kết nối tới Tracker Server để gửi nhiều request liên tiếp (truyền cho tracker_request)."""
+        with socket.create_connection((self.trackerHost, self.trackerPort)) as client_socket:
+            with client_socket.makefile('rb') as stream:
+                yield client_socket, stream
+
+    def tracker_request(self, request: str, body: bytes = b'', read_reply=None, connection=None):
+        """Gửi một request (một dòng text, có thể kèm dữ liệu) tới Tracker Server và đọc phản hồi.
+
+        read_reply: hàm đọc phản hồi nhị phân từ stream (xem TrackerProtocol); mặc định đọc một dòng text.
+        connection: kết nối mở bởi tracker_connection để dùng lại; mặc định mở một kết nối riêng cho request này.
+        """
+        if connection is None:
+            with self.tracker_connection() as connection:
+                return self.tracker_request(request, body, read_reply, connection)
+        started = time.perf_counter()
+        client_socket, stream = connection
+        client_socket.sendall(request.encode() + b'\n' + body)
+        if read_reply is None:
+            reply = stream.readline().decode().strip()
+        else:
+            reply = read_reply(stream)
+        self.metrics.observe('tracker_request_time', time.perf_counter() - started)
+        return reply
+
+    def publish_manifest(self, file: FileHandler, connection=None):
+        """Gửi manifest của file lên Tracker Server (connection: như tracker_request)."""
+        manifest = file.get_manifest().to_bytes()
+        response = self.tracker_request(f"MANIFEST {file.fileID} {len(manifest)}", manifest, connection=connection)
+        logger.debug("Response from server: %s", response)
+
+    def fetch_manifest(self, fileID: str, digest: bytes = None) -> Manifest:
+        """Lấy manifest của fileID từ Tracker Server và kiểm tra manifest đúng là của fileID.
+
+        digest: SHA-256 của manifest lấy từ get_file_info (nếu có) để kiểm tra thêm.
+        """
+        data = self.tracker_request(f"GETMANIFEST {fileID}", read_reply=TrackerProtocol.read_blob)
+        if not data:
+            raise RuntimeError(f"Tracker has no manifest for {fileID}.")
+        if digest is not None and hashlib.sha256(data).digest() != digest:
+            raise ValueError(f"Manifest from tracker does not match the metadata of {fileID}.")
+        manifest = Manifest.from_bytes(data)
+        if manifest.file_id() != fileID:
+            raise ValueError(f"Manifest from tracker does not match {fileID}.")
+        return manifest
+
+    def get_file_info(self, fileID: str) -> tuple:
+        """Lấy thông tin của fileID từ Tracker Server mà không cần tải manifest.
 
-    def download_file(self, fileID: str, totalChunks: int):
-        """Download file từ các peer và có thể mở server chia sẻ lại ngay khi tải được một phần."""
+        Trả về (tên file, kích thước, kích thước chunk, số chunk, SHA-256 của manifest).
+        """
+        return self.tracker_request(f"INFO {fileID}", read_reply=TrackerProtocol.read_file_info)
+
+    def get_peers(self, fileID: str, numwant: int = TrackerProtocol.DEFAULT_NUMWANT) -> tuple:
+        """Lấy tối đa numwant peer (chọn ngẫu nhiên) đang chia sẻ fileID từ Tracker Server.
+
+        Trả về (tên file, tổng số peer, danh sách (ip, port)).
+        """
+        return self.tracker_request(f"GET {fileID} {numwant}", read_reply=TrackerProtocol.read_peers)
+
+    def download_file(self, fileID: str, totalChunks: int = None, window: int = DEFAULT_WINDOW,
+                      max_outstanding: int = DEFAULT_MAX_OUTSTANDING, output_path: str = None,
+                      resume: bool = True, numwant: int = TrackerProtocol.DEFAULT_NUMWANT):
+        """Download file từ các peer và có thể mở server chia sẻ lại ngay khi tải được một phần.
+
+        totalChunks: không cần nữa, tên file và số chunk được lấy từ thông tin của file trên tracker.
+        window: số request tối đa đang chờ trên mỗi peer.
+        max_outstanding: số request tối đa đang chờ trên toàn bộ các peer.
+        output_path: nơi lưu file (mặc định là tên file do tracker trả về).
+        resume: tiếp tục từ journal (output_path + '.resume') nếu lần tải trước bị dừng giữa chừng.
+        numwant: số peer tối đa lấy từ tracker.
+        """
         self.fileID = fileID
-        self.chunks = [FileChunk] * int(totalChunks)
-        self.bitField = [0] * int(totalChunks)
+        self.file = None
+        info_name, file_size, chunk_size, chunk_count, digest = self.get_file_info(fileID)
+        if not chunk_size:
+            raise RuntimeError(f"Tracker has no metadata for {fileID}.")
+        if totalChunks is not None and int(totalChunks) != chunk_count:
+            logger.warning("Ignoring totalChunks=%s, the file has %d chunks.", totalChunks, chunk_count)
+        self.manifest = self.fetch_manifest(fileID, digest)
+        self.totalChunks = self.manifest.chunkCount
+        # Mỗi chunk một byte (1 = đã có), xem các hàm bitfield trong PiecePicker
+        self.bitField = bytearray(self.totalChunks)
         self.numDownloaded = 0
-        self.totalChunks = totalChunks
         # Khởi động server để chia sẻ các phần đã tải (nếu cần)
         self.start_peer_server()
 
-        client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        client_socket.connect((TRACKER_HOST, TRACKER_PORT))
-        request = f"GET {fileID}"
-        client_socket.sendall(request.encode())
-        response = client_socket.recv(1024).decode()     
-        #file_name = client_socket.recv(1024).decode()   
-        print('List: \n'.join([":".join(line.split(':')[1:]) for line in response.splitlines()]))
-        
-        peers = response.split('\n')
-        
+        _, total, peers = self.get_peers(fileID, numwant)
+        logger.info("Got %d of %d peers for %s", len(peers), total, fileID)
+        logger.debug("Peers: %s", ', '.join(f"{ip}:{port}" for ip, port in peers))
 
+        # Kết nối song song tới các peer để peer đã chết chỉ tốn một CONNECT_TIMEOUT
+        peers = [(ip, port) for ip, port in peers if (ip, port) != (self.peerHost, self.peerPort)]
         neighbors = []
-        file_name = ""
-        for peer in peers:
-            name, ip, port = peer.split(':')
-            file_name = name
-            port = int(port)
-            neighbor = self.generate_neighbor(self.fileID, ip, port)
-            neighbors.append(neighbor)
-
-
-        while self.numDownloaded < self.totalChunks:
-
-            neededChunks = self.get_needed_chunks()
-            # Tìm mảnh tệp hiếm nhất
-            rarest_chunk = self.get_rarest_chunk(neighbors, needed_chunks=neededChunks)
-            print('rarest_chunk: ', rarest_chunk)
-            # Chọn peer tốt nhất để tải mảnh này
-            best_peer = self.choose_best_peer(neighbors, rarest_chunk)
-            
-            if best_peer:
-                # Kết nối và yêu cầu mảnh tệp
-                
-                conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                conn.connect((best_peer['ip'], best_peer['port']))
-                
-                request = f'GET {self.fileID} {rarest_chunk}'
-                conn.sendall(request.encode())
-                chunk = FileChunk.from_bytes(conn.recv(16384))
-                if rarest_chunk == chunk.chunkID:
-                    file_chunk = FileChunk(rarest_chunk, chunk.data)
-                else:
-                    print("error chunk")
-                
-                # Kiểm tra tính toàn vẹn của mảnh tệp (giả lập kiểm tra hash)
-                self.numDownloaded = self.numDownloaded + 1
-                self.bitField[rarest_chunk] = 1
-                self.chunks[rarest_chunk] = file_chunk
-                print(f"Đã tải thành công mảnh {rarest_chunk} từ peer {best_peer['ip']}:{best_peer['port']}")
+        if peers:
+            with ThreadPoolExecutor(max_workers=min(CONNECT_WORKERS, len(peers))) as pool:
+                for neighbor in pool.map(lambda addr: self.try_generate_neighbor(self.fileID, *addr), peers):
+                    if neighbor is not None:
+                        neighbors.append(neighbor)
 
-            else:
-                print(f"Không tìm thấy peer có mảnh {rarest_chunk} hoặc tất cả đều bị choke.")
+        # Cấp phát trước file đích; mỗi chunk được ghi thẳng vào đúng vị trí khi vừa tải xong
+        file_name = output_path or info_name or fileID
+        self.file = FileHandler.create_for_download(file_name, self.manifest)
+        self.journal = ResumeJournal(file_name, fileID, self.totalChunks)
+        if resume:
+            self.resume_download()
+        else:
+            self.journal.open()
+            self.journal.reset([])
+        # Chia sẻ lại các chunk đã có ngay trong lúc tải
+        share = self.add_share(self.file, self.bitField, pinned=True)
+        # Announce là leecher để các peer khác tìm thấy; khi tải xong announce lại là seeder
+        share['announced'] = True
+        self.try_announce([share])
+        self.start_announcer()
+
+        # Tải song song từ tất cả các neighbor, mỗi neighbor có cửa sổ request riêng
+        downloader = Downloader(self, neighbors, window=window, max_outstanding=max_outstanding)
+        self.downloader = downloader
+        if self.download_stop.is_set():
+            downloader.stop()
+        complete = downloader.run()
+        self.downloader = None
+        self.file.flush()
+        share['pinned'] = False
+        if not complete:
+            self.journal.close()
+            if self.download_stop.is_set():
+                raise RuntimeError(f"Download of {fileID} was stopped at {self.numDownloaded}/{self.totalChunks} chunks.")
+            missing = self.totalChunks - self.numDownloaded
+            raise RuntimeError(f"Download of {fileID} incomplete: {missing} chunks (first: {first_missing(self.bitField)}) "
+                               f"are not available from any peer.")
         
-        FileHandler.combine_chunks(self.chunks, file_name)
-        self.verify_file_integrity(self.fileID)
+        logger.info("File has been successfully downloaded and saved at: %s", file_name)
+        if not self.verify_file_integrity(self.fileID, file_name):
+            self.journal.close()
+            raise RuntimeError(f"Downloaded file {file_name} does not match {fileID}.")
+        self.journal.remove()
+        self.try_announce([share])
 
-    def generate_neighbor(self, fileID, ip, port):
-        connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        connection.connect((ip, port))
+    def stop_download(self):
+        """Dừng lần tải đang chạy (gọi từ thread khác); download_file giữ lại journal và báo lỗi RuntimeError.
 
-        # Gửi yêu cầu nhận Bitfield từ peer
-        request_message = f'BITFIELD {fileID}'
-        connection.sendall(request_message.encode())
-        
-        # Nhận Bitfield từ peer
-        bitfield_data = connection.recv(1024)  # Giả sử 1024 byte đủ để lưu Bitfield
-
-        # Giải mã Bitfield và lưu lại các mảnh tệp mà peer này có
-        chunks = []
-        bitfield = struct.unpack('B' * len(bitfield_data), bitfield_data)
-        for i, bit in enumerate(bitfield):
-            if bit == 1:
-                chunks.append(i)  # Peer có mảnh tệp thứ i
-        return {'ip' : ip,'port' : port, 'chunks': chunks}
-
-    def get_needed_chunks(self):
-        neededChunks = []
-        for i, bit in enumerate(self.bitField):
-            if bit == 0:
-                neededChunks.append(i)
-        return neededChunks
-    def get_rarest_chunk(self, peers, needed_chunks):
-        # Tìm mảnh tệp hiếm nhất mà chúng ta chưa có
-        chunk_count = {chunk: 0 for chunk in needed_chunks}
-        for peer in peers:
-            for chunk in peer['chunks']:
-                if chunk in chunk_count:
-                    chunk_count[chunk] += 1
-        
-        # Sắp xếp theo số lần xuất hiện tăng dần
-        rarest_chunk = sorted(chunk_count.items(), key=lambda item: item[1])[0][0]
-        return rarest_chunk
+        Các chunk đã tải vẫn được chia sẻ; gọi lại download_file (resume=True) sau khi clear download_stop để tải tiếp.
+        """
+        self.download_stop.set()
+        downloader = self.downloader
+        if downloader is not None:
+            downloader.stop()
 
-    def choose_best_peer(self, peers, chunk_index):
-        # Chọn peer có mảnh tệp theo các tiêu chí: tốc độ, unchoke, độ trễ
-        available_peers = [peer for peer in peers if chunk_index in peer['chunks']]
-        
-        if not available_peers:
-            return None  # Không có peer nào có mảnh tệp này
-        return available_peers[0]  
+    def resume_download(self):
+        """Đọc journal của lần tải trước, kiểm tra lại (song song) các chunk đã ghi và chỉ giữ các chunk đúng."""
+        recorded = self.journal.open()
+        if not recorded:
+            return
+        verified = self.file.verify_chunks(recorded)
+        self.journal.reset(verified)
+        for chunk_num in verified:
+            self.bitField[chunk_num] = 1
+        self.numDownloaded = len(verified)
+        logger.info("Resuming %s: %d/%d chunks already on disk.", self.fileID, len(verified), self.totalChunks)
+
+    def try_generate_neighbor(self, fileID, ip, port):
+        """Như generate_neighbor nhưng trả về None nếu không kết nối được (bỏ qua peer đó thay vì dừng cả quá trình tải)."""
+        try:
+            return self.generate_neighbor(fileID, ip, port)
+        except (OSError, struct.error) as e:
+            logger.warning("Không kết nối được tới peer %s:%s: %s", ip, port, e)
+            return None
+
+    def generate_neighbor(self, fileID, ip, port):
+        """Mở kết nối lâu dài tới peer, gửi HANDSHAKE và nhận Bitfield của peer."""
+        # Chỉ giới hạn thời gian khi kết nối và chờ Bitfield; sau đó kết nối dùng chế độ blocking
+        connection = socket.create_connection((ip, port), CONNECT_TIMEOUT)
+        try:
+            # Gửi kèm cổng peer server của mình để bên kia tính tit-for-tat
+            connection.sendall(PeerProtocol.encode_message(PeerProtocol.HANDSHAKE, f"{fileID} {self.peerPort}".encode()))
+
+            # Nhận Bitfield từ peer
+            msg_type, bitfield_data = PeerProtocol.recv_message(connection)
+            if msg_type != PeerProtocol.BITFIELD:
+                raise ConnectionError(f"Peer {ip}:{port} does not share {fileID}: {bitfield_data.decode(errors='replace')}")
+            # Giải mã Bitfield thành bitmap int: bit i bật nếu peer có mảnh tệp thứ i
+            total_chunks, bits = PeerProtocol.decode_bitfield(bitfield_data)
+            if total_chunks != self.totalChunks:
+                raise ConnectionError(f"Peer {ip}:{port} has {total_chunks} chunks, expected {self.totalChunks}.")
+        except (OSError, struct.error):
+            connection.close()
+            raise
+        connection.settimeout(None)
 
+        return {'ip' : ip,'port' : port, 'bits': bits, 'conn': connection}
 
-    def verify_file_integrity(self, fileID: str):
-        """Giả lập kiểm tra tính toàn vẹn của file sau khi tải xong."""
-        print(f"Verifying integrity of {fileID}...")
+    def verify_file_integrity(self, fileID: str, file_path: str) -> bool:
+        """Kiểm tra tính toàn vẹn của file sau khi tải xong bằng cách tính lại fileID."""
+        logger.info("Verifying integrity of %s...", fileID)
+        file = FileHandler(file_path, self.manifest.chunkSize, lazy=True)
+        try:
+            return file.fileID == fileID
+        finally:
+            file.close()
 
 
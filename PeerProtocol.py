@@ -0,0 +1,118 @@
+import asyncio
+import struct
+
+# Mỗi message có dạng: [length (4 bytes)] + [type (1 byte)] + [payload]
+# length là độ dài của type + payload, nên một message rỗng có length = 1.
+HEADER = struct.Struct('!IB')
+INDEX = struct.Struct('!I')
+MAX_MESSAGE_SIZE = 64 * 1024 * 1024
+
+# Các loại message trên kết nối peer-wire
+HANDSHAKE = 0  # payload: fileID (ascii), tuỳ chọn theo sau là ' ' + cổng peer server của bên gửi
+BITFIELD = 1   # payload: số chunk (4 bytes) + bitfield, 8 chunk mỗi byte (xem encode_bitfield)
+REQUEST = 2    # payload: chunk index
+PIECE = 3      # payload: chunk index + dữ liệu chunk
+HAVE = 4       # payload: chunk index mà peer gửi vừa tải xong
+CANCEL = 5     # payload: chunk index không còn cần nữa
+REJECT = 6     # payload: chunk index không có sẵn
+ERROR = 7      # payload: thông báo lỗi (utf-8)
+CHOKE = 8           # không payload: server bỏ qua các request, các request đang chờ bị huỷ
+UNCHOKE = 9         # không payload: server nhận request trở lại
+INTERESTED = 10     # không payload: bên tải cần chunk mà server có
+NOT_INTERESTED = 11 # không payload: bên tải không cần chunk nào của server nữa
+
+
+def encode_message(msg_type: int, payload: bytes = b'') -> bytes:
+    """
+    Encode a message as a length-prefixed frame.
+    :param msg_type: One of the message type constants above.
+    :param payload: The message payload.
+    :return: The encoded frame.
+    """
+    return HEADER.pack(len(payload) + 1, msg_type) + payload
+
+
+def encode_index(msg_type: int, index: int) -> bytes:
+    """Encode a message whose payload is a single chunk index (REQUEST, HAVE, CANCEL, REJECT)."""
+    return HEADER.pack(INDEX.size + 1, msg_type) + INDEX.pack(index)
+
+
+def piece_header(index: int, length: int) -> bytes:
+    """
+    Encode the header of a PIECE message carrying length bytes of chunk data.
+    The chunk data itself is sent right after it, so it never has to be copied into the frame.
+    """
+    return HEADER.pack(INDEX.size + length + 1, PIECE) + INDEX.pack(index)
+
+
+def encode_bitfield(bits: int, total_chunks: int) -> bytes:
+    """
+    Encode a BITFIELD message from an int bitmap (bit i set = chunk i is available).
+    Chunk i is stored in bit i % 8 of byte i // 8, so 8 chunks fit in one byte and the
+    conversion to and from an int bitmap is a single int.to_bytes / int.from_bytes call.
+    """
+    packed = (bits & ((1 << total_chunks) - 1)).to_bytes((total_chunks + 7) // 8, 'little')
+    return encode_message(BITFIELD, INDEX.pack(total_chunks) + packed)
+
+
+def decode_bitfield(payload: bytes) -> tuple:
+    """
+    Decode the payload of a BITFIELD message.
+    :return: A (total_chunks, bits) tuple where bits is an int bitmap.
+    """
+    total_chunks = INDEX.unpack_from(payload)[0]
+    packed = payload[INDEX.size:]
+    if len(packed) != (total_chunks + 7) // 8:
+        raise ConnectionError("Bitfield length does not match the chunk count.")
+    return total_chunks, int.from_bytes(packed, 'little') & ((1 << total_chunks) - 1)
+
+
+def decode_index(payload: bytes) -> int:
+    """Decode the chunk index at the start of a payload."""
+    return INDEX.unpack_from(payload)[0]
+
+
+def recv_exact(sock, size: int) -> bytes:
+    """
+    Read exactly size bytes from a blocking socket.
+    :raises ConnectionError: If the peer closes the connection first.
+    """
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[received:], size - received)
+        if n == 0:
+            raise ConnectionError("Connection closed by peer.")
+        received += n
+    return bytes(buffer)
+
+
+def recv_message(sock) -> tuple:
+    """
+    Read one framed message from a blocking socket.
+    :return: A (msg_type, payload) tuple.
+    """
+    length, msg_type = HEADER.unpack(recv_exact(sock, HEADER.size))
+    if length < 1 or length > MAX_MESSAGE_SIZE:
+        raise ConnectionError(f"Invalid message length {length}.")
+    payload = recv_exact(sock, length - 1) if length > 1 else b''
+    return msg_type, payload
+
+
+async def read_message(reader, timeout: float = None) -> tuple:
+    """
+    Read one framed message from an asyncio StreamReader.
+    :param timeout: Seconds to wait for the next message; asyncio.TimeoutError is raised
+                    before any byte of the message is consumed, so the stream stays usable.
+    :return: A (msg_type, payload) tuple.
+    """
+    header = await asyncio.wait_for(reader.readexactly(HEADER.size), timeout)
+    length, msg_type = HEADER.unpack(header)
+    if length < 1 or length > MAX_MESSAGE_SIZE:
+        raise ConnectionError(f"Invalid message length {length}.")
+    try:
+        payload = await asyncio.wait_for(reader.readexactly(length - 1), timeout) if length > 1 else b''
+    except asyncio.TimeoutError:
+        raise ConnectionError("Timed out in the middle of a message.")
+    return msg_type, payload
@@ -0,0 +1,77 @@
+import math
+import time
+
+EWMA_ALPHA = 0.3          # Trọng số của mẫu mới trong trung bình trượt
+DEFAULT_MAX_WINDOW = 64   # Số request tối đa đang chờ trên một peer nhanh
+FAILURE_PENALTY = 0.5     # Mỗi lần thất bại gần đây làm điểm của peer giảm một nửa
+
+
+class PeerScore:
+    def __init__(self):
+        """
+        Download statistics of one remote peer, updated as chunks complete.
+        throughput is an EWMA of the rate at which the peer delivers chunk data (bytes/s),
+        rtt is an EWMA of the time between sending a request and receiving the whole chunk
+        (minRtt, its minimum, leaves out the queueing behind earlier pipelined requests), and
+        failures counts recent rejected, corrupted or lost requests (it decays with every
+        successful chunk).
+        """
+        self.throughput = None
+        self.rtt = None
+        self.minRtt = None
+        self.failures = 0
+        self.chunks = 0
+        self.bytes = 0
+        self.lastPiece = None
+
+    def record_chunk(self, nbytes: int, requested_at: float, now: float = None):
+        """
+        Records a chunk received from the peer.
+        With pipelining the peer is busy from the later of the request time and the previous
+        chunk's arrival, so only that interval counts towards the throughput sample.
+        :param nbytes: Size of the chunk.
+        :param requested_at: time.monotonic() when the chunk was requested.
+        """
+        now = time.monotonic() if now is None else now
+        busy_since = requested_at if self.lastPiece is None else max(requested_at, self.lastPiece)
+        self.lastPiece = now
+        latency = now - requested_at
+        self.rtt = self._ewma(self.rtt, latency)
+        self.minRtt = latency if self.minRtt is None else min(self.minRtt, latency)
+        elapsed = now - busy_since
+        if elapsed > 0:
+            self.throughput = self._ewma(self.throughput, nbytes / elapsed)
+        self.chunks += 1
+        self.bytes += nbytes
+        self.failures = max(0, self.failures - 1)
+
+    def record_failure(self):
+        """Records a rejected, corrupted or lost request."""
+        self.failures += 1
+
+    def score(self, default: float = 0.0) -> float:
+        """
+        Expected download rate from the peer (bytes/s), discounted by recent failures.
+        :param default: Rate assumed for a peer that has not delivered any chunk yet.
+        """
+        rate = default if self.throughput is None else self.throughput
+        return rate * FAILURE_PENALTY ** self.failures
+
+    def window(self, chunk_size: int, base: int, max_window: int = DEFAULT_MAX_WINDOW) -> int:
+        """
+        Number of requests to keep in flight on the peer.
+        Until the peer is measured this is base; afterwards it is the bandwidth-delay product
+        (throughput * minRtt, in chunks) plus one, so fast peers get deep pipelines and slow or
+        failing peers are limited to a few requests.
+        """
+        if self.throughput is None:
+            window = base
+        else:
+            window = math.ceil(self.throughput * self.minRtt / chunk_size) + 1
+        if self.failures:
+            window = max(1, window >> self.failures)
+        return max(1, min(max_window, window))
+
+    @staticmethod
+    def _ewma(average, sample: float) -> float:
+        return sample if average is None else average + EWMA_ALPHA * (sample - average)
@@ -0,0 +1,155 @@
+import random
+from array import array
+
+
+# Bitfield dạng bytearray: mỗi chunk một byte, 1 = đã có, 0 = còn thiếu
+_BIT_CHARS = bytes.maketrans(b'\x00\x01', b'01')
+
+
+def bits_from_bitfield(bitField: bytearray) -> int:
+    """Build an int bitmap from a bytearray bitfield (one byte per chunk, 1 = have) in C speed."""
+    if not bitField:
+        return 0
+    # Chunk i là chữ số nhị phân thứ i tính từ phải sang
+    return int(bytes(bitField).translate(_BIT_CHARS)[::-1], 2)
+
+
+def first_missing(bitField: bytearray) -> int:
+    """Returns the index of the first missing chunk of a bytearray bitfield, or -1 if none is missing."""
+    return bitField.find(0)
+
+
+def lowest_bit(bits: int) -> int:
+    """Returns the index of the lowest set bit of a non-zero bitmap."""
+    return (bits & -bits).bit_length() - 1
+
+
+class PiecePicker:
+    def __init__(self, total_chunks: int, completed: int = 0):
+        """
+        Rarest-first piece selection index.
+        Every peer's availability is an int bitmap (bit i set = the peer has chunk i), and
+        chunks are grouped in buckets by how many peers have them (buckets[k] is the bitmap
+        of chunks held by exactly k peers). Updates are incremental but not O(1): every bitmap
+        operation copies an N-bit int (N = number of chunks), so a HAVE or a completed chunk
+        costs a few O(N/30) word operations in C, a peer joining or leaving costs one per
+        bucket plus a Python loop over the chunks it has, and a pick ANDs the buckets from the
+        rarest up until one intersects the peer's wanted chunks, O(buckets * N/30) at worst.
+        This stays cheap because choose_chunk_size keeps N at most TARGET_CHUNKS (1024) for
+        files up to 4 GiB: a pick is a few microseconds there, but about 100 us at 100k chunks.
+        :param total_chunks: Number of chunks in the file.
+        :param completed: Bitmap of chunks that are already downloaded.
+        """
+        self.totalChunks = total_chunks
+        self.allBits = (1 << total_chunks) - 1
+        self.completed = completed & self.allBits
+        self.wanted = self.allBits & ~self.completed  # Chưa tải và chưa được yêu cầu
+        self.availability = array('I', bytes(4 * total_chunks))
+        self.buckets = [self.allBits]
+
+    def add_peer(self, bits: int):
+        """Adds a peer's availability bitmap to the index."""
+        bits &= self.allBits
+        if not bits:
+            return
+        self.buckets.append(0)
+        # Dịch các chunk của peer lên một bucket, bắt đầu từ bucket cao nhất
+        for k in range(len(self.buckets) - 2, -1, -1):
+            moving = self.buckets[k] & bits
+            if moving:
+                self.buckets[k] &= ~moving
+                self.buckets[k + 1] |= moving
+        self._trim()
+        for i in self._indices(bits):
+            self.availability[i] += 1
+
+    def remove_peer(self, bits: int):
+        """Removes a peer's availability bitmap from the index (the peer disconnected)."""
+        bits &= self.allBits
+        if not bits:
+            return
+        for k in range(1, len(self.buckets)):
+            moving = self.buckets[k] & bits
+            if moving:
+                self.buckets[k] &= ~moving
+                self.buckets[k - 1] |= moving
+        self._trim()
+        for i in self._indices(bits):
+            self.availability[i] -= 1
+
+    def peer_has(self, chunk_id: int):
+        """A peer announced (HAVE) a chunk it did not have before (two O(N) bitmap operations)."""
+        k = self.availability[chunk_id]
+        bit = 1 << chunk_id
+        if k + 1 == len(self.buckets):
+            self.buckets.append(0)
+        self.buckets[k] &= ~bit
+        self.buckets[k + 1] |= bit
+        self.availability[chunk_id] = k + 1
+
+    def peer_lost(self, chunk_id: int):
+        """A peer turned out not to have a chunk (rejected it or sent corrupted data)."""
+        k = self.availability[chunk_id]
+        if k == 0:
+            return
+        bit = 1 << chunk_id
+        self.buckets[k] &= ~bit
+        self.buckets[k - 1] |= bit
+        self.availability[chunk_id] = k - 1
+        self._trim()
+
+    def pick(self, peer_bits: int):
+        """
+        Picks the rarest wanted chunk the peer has, choosing randomly among equally rare chunks.
+        The chunk is marked as requested until release() or complete() is called.
+        Costs one O(N) AND per bucket scanned, so O(buckets * N) when the rarest chunks are
+        all held by other peers.
+        :return: The chunk index, or None if the peer has no wanted chunk.
+        """
+        candidates_all = peer_bits & self.wanted
+        if not candidates_all:
+            return None
+        for k in range(1, len(self.buckets)):
+            candidates = self.buckets[k] & candidates_all
+            if candidates:
+                # Chọn ngẫu nhiên: lấy bit thấp nhất kể từ một vị trí ngẫu nhiên
+                start = random.randrange(self.totalChunks)
+                upper = candidates >> start
+                chunk_id = start + lowest_bit(upper) if upper else lowest_bit(candidates)
+                self.wanted &= ~(1 << chunk_id)
+                return chunk_id
+        return None
+
+    def release(self, chunk_id: int):
+        """Makes a requested chunk available for picking again (its request failed)."""
+        bit = 1 << chunk_id
+        if not self.completed & bit:
+            self.wanted |= bit
+
+    def complete(self, chunk_id: int):
+        """Marks a chunk as downloaded."""
+        bit = 1 << chunk_id
+        self.completed |= bit
+        self.wanted &= ~bit
+
+    def needs_from(self, peer_bits: int) -> bool:
+        """True if the peer has a chunk that is not downloaded yet (requested or not)."""
+        return bool(peer_bits & self.allBits & ~self.completed)
+
+    def missing(self, peer_bits: int) -> list:
+        """Returns the indices of the chunks the peer has that are not downloaded yet (requested or not)."""
+        return list(self._indices(peer_bits & self.allBits & ~self.completed))
+
+    def _trim(self):
+        while len(self.buckets) > 1 and not self.buckets[-1]:
+            self.buckets.pop()
+
+    @staticmethod
+    def _indices(bits: int):
+        """Yields the indices of the set bits of a bitmap."""
+        data = bits.to_bytes((bits.bit_length() + 7) // 8, 'little')
+        for byte_index, byte in enumerate(data):
+            while byte:
+                low = byte & -byte
+                yield byte_index * 8 + low.bit_length() - 1
+                byte ^= low
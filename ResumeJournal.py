@@ -0,0 +1,103 @@
+import os
+import time
+import struct
+import threading
+
+JOURNAL_SUFFIX = '.resume'
+MAGIC = b'P2PR'
+VERSION = 1
+# Header: [magic (4 bytes)] + [version (1 byte)] + [fileID (32 bytes)] + [chunkCount (4 bytes)]
+HEADER = struct.Struct('!4sB32sI')
+SYNC_EVERY = 64        # fsync sau mỗi 64 chunk ...
+SYNC_INTERVAL = 2.0    # ... hoặc sau 2 giây, tuỳ điều kiện nào tới trước
+
+
+class ResumeJournal:
+    def __init__(self, output_path: str, fileID: str, chunk_count: int):
+        """
+        On-disk bitfield journal stored next to a partially downloaded file.
+        The journal holds a reference to the file (its fileID, which authenticates the
+        manifest) and one bit per chunk (chunk i is bit i % 8 of byte i // 8).
+        :param output_path: Path of the file being downloaded; the journal is output_path + '.resume'.
+        :param fileID: The fileID of the download.
+        :param chunk_count: Number of chunks in the file.
+        """
+        self.path = output_path + JOURNAL_SUFFIX
+        self.fileID = fileID
+        self.chunkCount = chunk_count
+        self.bits = bytearray((chunk_count + 7) // 8)
+        self.fileObj = None
+        self.lock = threading.Lock()
+        self.unsynced = 0
+        self.lastSync = time.monotonic()
+
+    def open(self) -> list:
+        """
+        Opens the journal, creating it if it does not exist or belongs to another download.
+        :return: The chunk indices the journal records as already written.
+        """
+        header = HEADER.pack(MAGIC, VERSION, bytes.fromhex(self.fileID), self.chunkCount)
+        done = []
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+            if data[:HEADER.size] == header and len(data) == HEADER.size + len(self.bits):
+                self.bits[:] = data[HEADER.size:]
+                done = [i for i in range(self.chunkCount) if self.bits[i >> 3] & (1 << (i & 7))]
+        except OSError:
+            pass
+        if not done:
+            self.bits[:] = bytes(len(self.bits))
+            with open(self.path, 'wb') as f:
+                f.write(header + self.bits)
+        self.fileObj = open(self.path, 'r+b')
+        return done
+
+    def reset(self, chunk_ids: list):
+        """Rewrites the journal so that exactly chunk_ids are marked as written."""
+        with self.lock:
+            self.bits[:] = bytes(len(self.bits))
+            for chunk_id in chunk_ids:
+                self.bits[chunk_id >> 3] |= 1 << (chunk_id & 7)
+            self.fileObj.seek(HEADER.size)
+            self.fileObj.write(self.bits)
+            self._sync()
+
+    def mark(self, chunk_id: int):
+        """
+        Records that a chunk has been written to the output file.
+        Only the byte holding the chunk's bit is rewritten; the journal is fsynced periodically.
+        Does nothing once the journal is closed.
+        """
+        with self.lock:
+            if self.fileObj is None:
+                return
+            byte = chunk_id >> 3
+            self.bits[byte] |= 1 << (chunk_id & 7)
+            self.fileObj.seek(HEADER.size + byte)
+            self.fileObj.write(self.bits[byte:byte + 1])
+            self.unsynced += 1
+            if self.unsynced >= SYNC_EVERY or time.monotonic() - self.lastSync >= SYNC_INTERVAL:
+                self._sync()
+
+    def _sync(self):
+        self.fileObj.flush()
+        os.fsync(self.fileObj.fileno())
+        self.unsynced = 0
+        self.lastSync = time.monotonic()
+
+    def close(self):
+        """Flushes and closes the journal."""
+        with self.lock:
+            if self.fileObj is not None:
+                self._sync()
+                self.fileObj.close()
+                self.fileObj = None
+
+    def remove(self):
+        """Closes and deletes the journal once the download is complete."""
+        self.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
@@ -0,0 +1,132 @@
+import socket
+import struct
+
+# Mỗi request gửi tới tracker là một dòng text kết thúc bằng '\n' (ví dụ "GET <fileID> 50"),
+# có thể kèm dữ liệu nhị phân ngay sau dòng đó (MANIFEST). Một kết nối có thể gửi nhiều request.
+# Request theo lô (ANNOUNCE, SCRAPE) ghi số mục trên dòng đầu, theo sau là mỗi mục một dòng.
+# Phản hồi là một dòng text, trừ GET, GETMANIFEST, SCRAPE và INFO trả về dữ liệu nhị phân như dưới đây,
+# và STATS (JSON), PROFILE, TRACEMALLOC (text) trả về blob giống GETMANIFEST (xem read_blob).
+# Dòng phản hồi ANNOUNCE có thể kèm theo các fileID tracker chưa có manifest, mỗi fileID một dòng (xem read_announce).
+LENGTH = struct.Struct('!I')
+# Danh sách peer dạng compact: mỗi peer 6 byte = địa chỉ IPv4 (4 bytes) + port (2 bytes)
+PEER = struct.Struct('!4sH')
+# Header của phản hồi GET: [tổng số peer của file] + [số peer trong phản hồi] + [độ dài tên file]
+PEERS_HEADER = struct.Struct('!IIH')
+MAX_BODY_SIZE = 64 * 1024 * 1024
+DEFAULT_NUMWANT = 50     # Số peer trả về khi request không chỉ định
+MAX_NUMWANT = 1000       # Số peer tối đa trong một phản hồi
+MAX_BATCH = 65536        # Số fileID tối đa trong một request ANNOUNCE hoặc SCRAPE
+# Phản hồi SCRAPE: [số mục] + mỗi fileID (theo thứ tự trong request) [số seeder] + [số leecher]
+SCRAPE_ENTRY = struct.Struct('!II')
+# Phản hồi INFO: [kích thước file (8 bytes)] + [kích thước chunk (4 bytes)] + [số chunk (4 bytes)]
+# + [SHA-256 của manifest (32 bytes)] + [độ dài tên file (2 bytes)] + tên file; toàn 0 nếu tracker không biết fileID
+FILE_INFO = struct.Struct('!QII32sH')
+
+
+def encode_peer(ip: str, port: int) -> bytes:
+    """
+    Encode a peer address in the 6-byte compact form.
+    :raises OSError: If ip is not an IPv4 address.
+    :raises struct.error: If port is out of range.
+    """
+    return PEER.pack(socket.inet_aton(ip), port)
+
+
+def decode_peers(data: bytes) -> list:
+    """Decode a compact peer list into (ip, port) tuples."""
+    return [(socket.inet_ntoa(packed_ip), port) for packed_ip, port in PEER.iter_unpack(data)]
+
+
+def encode_peers(name: str, total: int, compact: bytes) -> bytes:
+    """
+    Encode the response to GET.
+    :param name: The file name registered for the fileID.
+    :param total: Number of peers the tracker knows for the fileID.
+    :param compact: The returned peers, already in compact form.
+    """
+    name = name.encode()
+    return PEERS_HEADER.pack(total, len(compact) // PEER.size, len(name)) + name + compact
+
+
+def encode_scrape(counts: list) -> bytes:
+    """
+    Encode the response to SCRAPE.
+    :param counts: A (seeders, leechers) tuple for each requested fileID.
+    """
+    return LENGTH.pack(len(counts)) + b''.join(SCRAPE_ENTRY.pack(*entry) for entry in counts)
+
+
+def encode_file_info(name: str, file_size: int, chunk_size: int, chunk_count: int, manifest_digest: bytes) -> bytes:
+    """Encode the response to INFO (manifest_digest is b'' until the manifest is published)."""
+    name = name.encode()
+    return FILE_INFO.pack(file_size, chunk_size, chunk_count, manifest_digest, len(name)) + name
+
+
+def encode_announce(message: str, interval: float, missing: list) -> bytes:
+    """
+    Encode the response to ANNOUNCE: "<message> Missing <n> Interval <seconds>", then the n
+    fileIDs the tracker has no manifest for, one per line.
+    Clients that only read the first line still find the interval at its end.
+    """
+    lines = [f"{message} Missing {len(missing)} Interval {interval:g}"] + missing
+    return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+def read_announce(stream) -> tuple:
+    """
+    Read the response to ANNOUNCE from a binary file object.
+    :return: A (response line, missing fileIDs) tuple.
+    """
+    line = stream.readline().decode().strip()
+    head, _, _ = line.rpartition(' Interval ')
+    _, found, count = head.rpartition(' Missing ')
+    missing = []
+    for _ in range(int(count) if found else 0):
+        file_id = stream.readline().decode().strip()
+        if not file_id:
+            raise ConnectionError("Connection closed by tracker.")
+        missing.append(file_id)
+    return line, missing
+
+
+def read_exact(stream, size: int) -> bytes:
+    """
+    Read exactly size bytes from a binary file object (for example socket.makefile('rb')).
+    :raises ConnectionError: If the stream ends first.
+    """
+    data = stream.read(size)
+    if len(data) != size:
+        raise ConnectionError("Connection closed by tracker.")
+    return data
+
+
+def read_peers(stream) -> tuple:
+    """
+    Read the response to GET from a binary file object.
+    :return: A (name, total, peers) tuple where peers is a list of (ip, port) tuples.
+    """
+    total, count, name_length = PEERS_HEADER.unpack(read_exact(stream, PEERS_HEADER.size))
+    name = read_exact(stream, name_length).decode()
+    return name, total, decode_peers(read_exact(stream, count * PEER.size))
+
+
+def read_blob(stream) -> bytes:
+    """Read a length-prefixed blob (the response to GETMANIFEST) from a binary file object."""
+    length = LENGTH.unpack(read_exact(stream, LENGTH.size))[0]
+    return read_exact(stream, length)
+
+
+def read_scrape(stream) -> list:
+    """Read the response to SCRAPE from a binary file object as a list of (seeders, leechers) tuples."""
+    count = LENGTH.unpack(read_exact(stream, LENGTH.size))[0]
+    return list(SCRAPE_ENTRY.iter_unpack(read_exact(stream, count * SCRAPE_ENTRY.size)))
+
+
+def read_file_info(stream) -> tuple:
+    """
+    Read the response to INFO from a binary file object.
+    :return: A (name, file_size, chunk_size, chunk_count, manifest_digest) tuple; manifest_digest
+             is 32 zero bytes if the tracker has no manifest for the fileID.
+    """
+    file_size, chunk_size, chunk_count, manifest_digest, name_length = FILE_INFO.unpack(read_exact(stream, FILE_INFO.size))
+    return read_exact(stream, name_length).decode(), file_size, chunk_size, chunk_count, manifest_digest
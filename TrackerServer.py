@@ -1,80 +1,488 @@
+import os
+import json
+import time
+import heapq
+import hashlib
 import socket
-import threading
-from typing import Dict, List
+import struct
+import random
+import asyncio
+import logging
+import argparse
+import ipaddress
+import TrackerProtocol
+import TrackerStore
+from FileHandler import Manifest
+from Metrics import Metrics
+from typing import Dict, List, Set, Tuple
+
+logger = logging.getLogger(__name__)
 
 SERVER_MASK = '0.0.0.0'
-SERVER_PORT = 5050
+SERVER_PORT = int(os.environ.get('TRACKER_PORT', 5050))  # Có thể đổi bằng biến môi trường TRACKER_PORT
+TRACKER_BACKLOG = 4096     # Hàng đợi kết nối của tracker
+CLIENT_TIMEOUT = 60        # Số giây tối đa chờ request tiếp theo trên một kết nối
+ANNOUNCE_INTERVAL = 300    # Số giây giữa hai lần announce (POST) của một peer, trả về cho client
+REAP_INTERVAL = 1          # Số giây giữa hai lần xoá các peer hết hạn
+# Các request được đếm riêng trong metrics; request khác được đếm chung là "invalid"
+COMMANDS = ('POST', 'ANNOUNCE', 'GET', 'SCRAPE', 'INFO', 'MANIFEST', 'GETMANIFEST', 'DELETE',
+            'STATS', 'PROFILE', 'TRACEMALLOC')
 
-class TrackerServer:
+
+class FileInfo:
+    def __init__(self):
+        """
+        Metadata of one fileID, stored once however many peers share the file.
+        The name is the one announced by the first peer. fileSize, chunkSize, chunkCount and
+        manifestDigest (SHA-256 of the manifest) come from the manifest once it is published;
+        until then chunkCount is the one announced by the first peer and the rest are 0 / b''.
+        """
+        self.name = ''
+        self.fileSize = 0
+        self.chunkSize = 0
+        self.chunkCount = 0
+        self.manifestDigest = b''
+
+    def set_manifest(self, manifest: Manifest, data: bytes):
+        """Takes the file size and chunk layout from a verified manifest."""
+        self.fileSize = manifest.fileSize
+        self.chunkSize = manifest.chunkSize
+        self.chunkCount = manifest.chunkCount
+        self.manifestDigest = hashlib.sha256(data).digest()
+
+    def matches(self, total_chunks: int) -> bool:
+        """False if the manifest is known and has a different number of chunks."""
+        return not self.manifestDigest or self.chunkCount == total_chunks
+
+
+class Swarm:
     def __init__(self):
-        self.peers: Dict[str, List[Dict[str, str, int]]] = {}  # Lưu thông tin về các peer theo fileID (name, ip, port)
-        self.lock = threading.Lock()  # Để đảm bảo thread-safe khi có nhiều kết nối đồng thời
+        """
+        Peers sharing one fileID.
+        Addresses are kept in a list (so a random sample costs O(k)) together with a dict from
+        (ip, port) to list position (so adding or removing a peer costs O(1): a removed peer is
+        swapped with the last one). Each peer is stored in compact form, ready to be sent, with
+        the time (time.monotonic()) after which it expires unless it announces again. Peers that
+        have the whole file (seeders) are also kept in a set so SCRAPE can count them in O(1).
+        """
+        self.addrs: List[Tuple[str, int]] = []
+        self.compact: List[bytes] = []
+        self.index: Dict[Tuple[str, int], int] = {}
+        self.expires: Dict[Tuple[str, int], float] = {}
+        self.seeders: Set[Tuple[str, int]] = set()
+
+    def __len__(self) -> int:
+        return len(self.addrs)
+
+    def add(self, addr: tuple, compact: bytes, expires: float, seeder: bool = True) -> bool:
+        """Adds a peer, or only renews its expiry time; returns False if it was already registered."""
+        self.expires[addr] = expires
+        if seeder:
+            self.seeders.add(addr)
+        else:
+            self.seeders.discard(addr)
+        if addr in self.index:
+            return False
+        self.index[addr] = len(self.addrs)
+        self.addrs.append(addr)
+        self.compact.append(compact)
+        return True
+
+    def remove(self, addr: tuple) -> bool:
+        """Removes a peer; returns False if it was not registered."""
+        position = self.index.pop(addr, None)
+        if position is None:
+            return False
+        del self.expires[addr]
+        self.seeders.discard(addr)
+        last_addr = self.addrs.pop()
+        last_compact = self.compact.pop()
+        if position < len(self.addrs):
+            self.addrs[position] = last_addr
+            self.compact[position] = last_compact
+            self.index[last_addr] = position
+        return True
+
+    def sample(self, limit: int) -> bytes:
+        """Returns up to limit peers in compact form, chosen at random when there are more."""
+        if len(self.compact) <= limit:
+            return b''.join(self.compact)
+        return b''.join(random.sample(self.compact, limit))
+
+    def counts(self) -> tuple:
+        """Returns (seeders, leechers)."""
+        return len(self.seeders), len(self.addrs) - len(self.seeders)
+
+
+class TrackerServer:
+    def __init__(self, host: str = None, port: int = None, announce_interval: float = ANNOUNCE_INTERVAL,
+                 peer_ttl: float = None, state_dir: str = None):
+        """
+        host, port: địa chỉ lắng nghe (mặc định SERVER_MASK:SERVER_PORT); port=0 để hệ thống chọn cổng trống (xem self.port).
+        announce_interval: chu kỳ announce trả về cho các peer.
+        peer_ttl: peer không announce lại trong khoảng thời gian này bị xoá (mặc định 2 chu kỳ announce).
+        state_dir: nếu có, lưu trạng thái (snapshot + log) vào thư mục này và khôi phục khi khởi động lại.
+        """
+        self.peers: Dict[str, Swarm] = {}  # Lưu các peer theo fileID
+        self.files: Dict[str, FileInfo] = {}  # Tên và thông tin chunk của từng fileID (một bản cho mọi peer)
+        self.manifests: Dict[str, bytes] = {}  # Manifest (dạng bytes) của từng fileID
+        self.announce_interval = announce_interval
+        self.peer_ttl = peer_ttl or 2 * announce_interval
+        # Heap (thời điểm hết hạn, fileID, (ip, port)); mục đã được gia hạn hoặc xoá được bỏ qua khi lấy ra
+        self.expiry_heap: List[Tuple[float, str, Tuple[str, int]]] = []
+        self.loop = None
+        self.server_stop = None
+        self.store = None
+        self.compactTask = None  # Task gộp log vào snapshot đang chạy (xem reap_loop)
+        self.metrics = Metrics()
+        if state_dir:
+            self.store = TrackerStore.TrackerStore(state_dir)
+            self.restore()
+        # Toàn bộ request được xử lý trong một event loop nên không cần lock
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server_socket.bind((SERVER_MASK, SERVER_PORT))
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server_socket.bind((host or SERVER_MASK, SERVER_PORT if port is None else port))
+        self.port = self.server_socket.getsockname()[1]
+
     def start(self):
         """Khởi động server và bắt đầu lắng nghe các kết nối."""
+        asyncio.run(self.serve())
 
-        self.server_socket.listen(5)
-        print(f"Tracker server is running...")
-        while True:
-            client_socket, addr = self.server_socket.accept()
-            print(f"Connection from {addr}")
-            threading.Thread(target=self.handle_client, args=(client_socket,)).start()
+    async def serve(self):
+        """Chạy asyncio server cho tới khi close() được gọi."""
+        self.server_stop = asyncio.Event()
+        server = await asyncio.start_server(self.handle_client, sock=self.server_socket,
+                                            backlog=TRACKER_BACKLOG)
+        self.loop = asyncio.get_running_loop()
+        logger.info("Tracker server is running on port %d...", self.port)
+        reaper = asyncio.create_task(self.reap_loop())
+        async with server:
+            await self.server_stop.wait()
+        reaper.cancel()
+        if self.compactTask is not None:
+            # Chờ snapshot đang ghi dở trước khi đóng store
+            await asyncio.wait([self.compactTask])
+        if self.store is not None:
+            self.store.close()
+        self.loop = None
 
     def close(self):
-        self.server_socket.close()
+        """Dừng server (gọi từ thread bất kỳ)."""
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.server_stop.set)
+        else:
+            self.server_socket.close()
 
-    def handle_client(self, client_socket: socket.socket):
-        """Xử lý các yêu cầu từ client."""
+    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Xử lý các request trên một kết nối, mỗi request là một dòng text."""
+        addr = writer.get_extra_info('peername')
+        logger.debug("Connection from %s", addr)
+        self.metrics.inc('connections')
         try:
-            request = client_socket.recv(1024).decode('utf-8')
-            if request.startswith("POST"):
-                _, file_name, file_id, totalChunks, ip, port = request.split()
-                self.register_peer(file_name, file_id, ip, int(port))
-                response = f"Post peer {ip}:{port} for fileID {file_id} TotalChunks {totalChunks}"
-                client_socket.send(response.encode('utf-8'))
-            elif request.startswith("GET"):
-                _, file_id = request.split()
-                peers = self.get_peers(file_id)
-                response = "\n".join(peers) if peers else "No peers available."
-                client_socket.send(response.encode('utf-8'))
-            elif request.startswith("DELETE"):
-                _, file_id, ip, port = request.split()
-                self.remove_peer(file_id, ip, int(port))
-                response = f"Deleted peer {ip}:{port} for fileID {file_id}"
-                client_socket.send(response.encode('utf-8'))
-            else:
-                client_socket.send(b"Invalid request.")
+            while True:
+                line = await asyncio.wait_for(reader.readline(), CLIENT_TIMEOUT)
+                if not line:
+                    break
+                request = line.decode('utf-8').strip()
+                command = request.partition(' ')[0]
+                if command not in COMMANDS:
+                    command = 'invalid'
+                started = time.perf_counter()
+                writer.write(await self.handle_request(request, reader, addr))
+                self.metrics.inc(f'requests.{command}')
+                self.metrics.observe(f'request_time.{command}', time.perf_counter() - started)
+                await writer.drain()
+        except asyncio.TimeoutError:
+            # Client giữ kết nối mà không gửi request nào: bình thường, không phải lỗi giao thức
+            logger.debug("Connection from %s timed out.", addr)
+        except asyncio.IncompleteReadError as e:
+            logger.debug("Connection from %s closed in the middle of a request: %r", addr, e)
+        except (OSError, ValueError, struct.error) as e:
+            self.metrics.inc('requests.failed')
+            logger.warning("Invalid request from %s: %r", addr, e)
         finally:
-            client_socket.close()
-
-    def register_peer(self, file_name: str, file_id: str, ip: str, port: int):
-        """Đăng ký peer vào danh sách chia sẻ file."""
-        with self.lock:
-            if file_id not in self.peers:
-                self.peers[file_id] = []
-            
-            self.peers[file_id].append({'name': file_name, 'ip': ip, 'port': port})
-            print(f"Peer registered: {ip}:{port} for fileID {file_id} with fileName {file_name}")
-
-    def get_peers(self, file_id: str) -> List[str]:
-        """Trả về danh sách các peer chia sẻ fileID."""
-        with self.lock:
-            
-            return [f"{peer['name']}:{peer['ip']}:{peer['port']}" for peer in self.peers.get(file_id, [])]
+            writer.close()
+
+    async def handle_request(self, request: str, reader: asyncio.StreamReader, addr: tuple = None) -> bytes:
+        """Xử lý một request và trả về phản hồi để gửi cho client.
+
+        addr: địa chỉ client; PROFILE và TRACEMALLOC chỉ được gọi từ chính máy chạy tracker.
+        """
+        command, _, args = request.partition(' ')
+        if command == "MANIFEST":
+            file_id, length = args.split()
+            length = int(length)
+            if not 0 <= length <= TrackerProtocol.MAX_BODY_SIZE:
+                raise ValueError(f"Manifest too large: {length} bytes")
+            body = await reader.readexactly(length)
+            if self.register_manifest(file_id, body):
+                return f"Stored manifest for fileID {file_id}\n".encode('utf-8')
+            return b"Invalid manifest.\n"
+        elif command == "GETMANIFEST":
+            manifest = self.get_manifest(args.strip())
+            return self.encode_blob(manifest)
+        elif command == "POST":
+            # Tên file có thể chứa dấu cách nên tách từ bên phải
+            file_name, file_id, totalChunks, ip, port = args.rsplit(' ', 4)
+            if not self.register_peer(file_name, file_id, ip, int(port), total_chunks=int(totalChunks)):
+                return f"Invalid totalChunks {totalChunks} for fileID {file_id}\n".encode('utf-8')
+            # Chu kỳ announce ở cuối phản hồi: peer phải POST lại trước khi hết hạn
+            return (f"Post peer {ip}:{port} for fileID {file_id} TotalChunks {totalChunks} "
+                    f"Interval {self.announce_interval:g}\n").encode('utf-8')
+        elif command == "ANNOUNCE":
+            # Announce nhiều file một lúc: "ANNOUNCE <ip> <port> <số file>", sau đó mỗi file một dòng
+            # "<fileID> <totalChunks> <số chunk còn thiếu> <tên file>"
+            # Phản hồi liệt kê các fileID tracker chưa có manifest (ví dụ sau khi khởi động lại không có --state-dir)
+            # để peer gửi lại bằng MANIFEST
+            ip, port, count = args.split()
+            port = int(port)
+            registered = 0
+            missing = []
+            for line in await self.read_batch(reader, count):
+                file_id, totalChunks, left, file_name = line.split(' ', 3)
+                if self.register_peer(file_name, file_id, ip, port, seeder=int(left) == 0,
+                                      total_chunks=int(totalChunks)):
+                    registered += 1
+                    if file_id not in self.manifests:
+                        missing.append(file_id)
+            return TrackerProtocol.encode_announce(
+                f"Announced {registered} of {count} files for peer {ip}:{port}", self.announce_interval, missing)
+        elif command == "SCRAPE":
+            # "SCRAPE <số file>", sau đó mỗi fileID một dòng; trả về số seeder và leecher của từng file
+            counts = [self.scrape(file_id) for file_id in await self.read_batch(reader, args)]
+            return TrackerProtocol.encode_scrape(counts)
+        elif command == "INFO":
+            return self.get_file_info(args.strip())
+        elif command == "STATS":
+            return self.encode_blob(json.dumps(self.stats()).encode('utf-8'))
+        elif command in ("PROFILE", "TRACEMALLOC"):
+            # "PROFILE start|stop": cProfile event loop của tracker; "TRACEMALLOC start|stop": bộ nhớ của process
+            if addr is None or not ipaddress.ip_address(addr[0]).is_loopback:
+                return self.encode_blob(b"Only allowed from localhost.\n")
+            action = args.strip()
+            if action == "start":
+                if command == "PROFILE":
+                    self.metrics.start_profiling()
+                else:
+                    self.metrics.start_tracemalloc()
+                return self.encode_blob(f"{command} started\n".encode('utf-8'))
+            if action == "stop":
+                report = self.metrics.stop_profiling() if command == "PROFILE" else self.metrics.stop_tracemalloc()
+                return self.encode_blob(report.encode('utf-8'))
+            return self.encode_blob(b"Invalid request.\n")
+        elif command == "GET":
+            file_id, _, numwant = args.partition(' ')
+            numwant = int(numwant) if numwant else TrackerProtocol.DEFAULT_NUMWANT
+            return self.get_peers(file_id, numwant)
+        elif command == "DELETE":
+            file_id, ip, port = args.split()
+            self.remove_peer(file_id, ip, int(port))
+            return f"Deleted peer {ip}:{port} for fileID {file_id}\n".encode('utf-8')
+        return b"Invalid request.\n"
+
+    @staticmethod
+    async def read_batch(reader: asyncio.StreamReader, count: str) -> List[str]:
+        """Đọc các dòng của một request theo lô (ANNOUNCE, SCRAPE)."""
+        count = int(count)
+        if not 0 <= count <= TrackerProtocol.MAX_BATCH:
+            raise ValueError(f"Batch too large: {count} entries")
+        lines = []
+        for _ in range(count):
+            line = await asyncio.wait_for(reader.readline(), CLIENT_TIMEOUT)
+            if not line.endswith(b'\n'):
+                raise asyncio.IncompleteReadError(line, None)
+            lines.append(line.decode('utf-8').rstrip('\r\n'))
+        return lines
+
+    def register_peer(self, file_name: str, file_id: str, ip: str, port: int, seeder: bool = True,
+                      total_chunks: int = None) -> bool:
+        """Đăng ký peer vào danh sách chia sẻ file, hoặc gia hạn nếu peer đã có trong danh sách.
+
+        seeder: peer đã có đủ file (False nếu peer đang tải dở).
+        total_chunks: số chunk peer announce; peer bị từ chối (trả về False) nếu khác với manifest.
+        """
+        if len(bytes.fromhex(file_id)) != 32:
+            raise ValueError(f"Invalid fileID {file_id}")
+        compact = TrackerProtocol.encode_peer(ip, port)
+        info = self.files.get(file_id)
+        if info is None:
+            info = self.files[file_id] = FileInfo()
+        if total_chunks is not None:
+            if not info.matches(total_chunks):
+                return False
+            if not info.manifestDigest:
+                info.chunkCount = total_chunks
+        if not info.name:
+            info.name = file_name
+            self.log(TrackerStore.encode_name(file_id, file_name))
+        swarm = self.peers.get(file_id)
+        if swarm is None:
+            swarm = self.peers[file_id] = Swarm()
+        expires = time.monotonic() + self.peer_ttl
+        heapq.heappush(self.expiry_heap, (expires, file_id, (ip, port)))
+        if swarm.add((ip, port), compact, expires, seeder):
+            self.log(TrackerStore.encode_peer_record(TrackerStore.REGISTER, file_id, compact))
+            logger.debug("Peer registered: %s:%s for fileID %s with fileName %s", ip, port, file_id, info.name)
+        return True
+
+    def reap_expired(self, now: float = None) -> int:
+        """Xoá các peer đã quá peer_ttl mà không announce lại. Trả về số peer bị xoá."""
+        now = time.monotonic() if now is None else now
+        heap = self.expiry_heap
+        removed = 0
+        while heap and heap[0][0] <= now:
+            expires, file_id, addr = heapq.heappop(heap)
+            swarm = self.peers.get(file_id)
+            # Bỏ qua mục cũ của peer đã announce lại (hạn mới lớn hơn) hoặc đã bị DELETE
+            if swarm is None or swarm.expires.get(addr) != expires:
+                continue
+            self.remove_peer(file_id, *addr)
+            removed += 1
+        return removed
+
+    async def reap_loop(self):
+        """Định kỳ xoá các peer hết hạn, ghi log xuống đĩa và gộp log vào snapshot khi cần."""
+        while True:
+            await asyncio.sleep(REAP_INTERVAL)
+            self.reap_expired()
+            if self.store is not None:
+                self.store.flush()
+                if (self.compactTask is None or self.compactTask.done()) and self.store.should_compact():
+                    # Giữ tham chiếu tới task: event loop chỉ giữ tham chiếu yếu nên task có thể bị thu hồi giữa chừng
+                    self.compactTask = asyncio.create_task(self.compact())
+                    self.compactTask.add_done_callback(self.compact_done)
+
+    def log(self, record: bytes):
+        """Ghi một thay đổi vào log nếu trạng thái được lưu xuống đĩa."""
+        if self.store is not None:
+            self.store.append(record)
+
+    def restore(self):
+        """Khôi phục các peer và manifest từ snapshot + log (gọi khi khởi động)."""
+        started = time.monotonic()
+        for kind, file_id, value in self.store.replay():
+            if kind == TrackerStore.MANIFEST:
+                if file_id not in self.manifests:
+                    self.manifests[file_id] = value
+                    self.files.setdefault(file_id, FileInfo()).set_manifest(Manifest.from_bytes(value), value)
+                continue
+            if kind == TrackerStore.NAME:
+                self.files.setdefault(file_id, FileInfo()).name = value
+                continue
+            swarm = self.peers.get(file_id)
+            if kind == TrackerStore.REGISTER:
+                if swarm is None:
+                    swarm = self.peers[file_id] = Swarm()
+                    self.files.setdefault(file_id, FileInfo())
+                # Trạng thái seeder không được lưu: peer được tính là seeder cho tới lần announce kế tiếp
+                swarm.add(TrackerProtocol.decode_peers(value)[0], value, 0.0)
+            elif swarm is not None and swarm.remove(TrackerProtocol.decode_peers(value)[0]) and not swarm:
+                del self.peers[file_id]
+        self.store.open()
+        # Peer được khôi phục không cần announce lại ngay: hạn của chúng được rải đều trong
+        # [announce_interval, peer_ttl] để peer còn sống kịp gia hạn và peer đã chết bị xoá dần
+        now = time.monotonic()
+        count = 0
+        for file_id, swarm in self.peers.items():
+            for addr in swarm.addrs:
+                expires = now + random.uniform(self.announce_interval, self.peer_ttl)
+                swarm.expires[addr] = expires
+                self.expiry_heap.append((expires, file_id, addr))
+                count += 1
+        heapq.heapify(self.expiry_heap)
+        logger.info("Restored %d peers of %d files and %d manifests in %.2fs",
+                    count, len(self.peers), len(self.manifests), time.monotonic() - started)
+
+    def snapshot_records(self) -> list:
+        """Mã hoá toàn bộ trạng thái hiện tại thành các bản ghi của snapshot (mỗi file một bản ghi)."""
+        records = [TrackerStore.encode_manifest(file_id, data) for file_id, data in self.manifests.items()]
+        records += [TrackerStore.encode_name(file_id, info.name) for file_id, info in self.files.items() if info.name]
+        for file_id, swarm in self.peers.items():
+            prefix = TrackerStore.RECORD.pack(TrackerStore.REGISTER, bytes.fromhex(file_id))
+            records.append(b''.join(prefix + compact for compact in swarm.compact))
+        return records
+
+    async def compact(self):
+        """Gộp log vào snapshot mới; snapshot được ghi trong thread khác để không chặn event loop."""
+        try:
+            records = self.snapshot_records()
+            self.store.begin_compact()
+            await asyncio.get_running_loop().run_in_executor(None, self.store.finish_compact, records)
+        except OSError as e:
+            logger.error("Tracker snapshot failed: %s", e)
+
+    @staticmethod
+    def compact_done(task: asyncio.Task):
+        """Ghi log lỗi bất ngờ của task compact (nếu không sẽ chỉ thấy "Task exception was never retrieved")."""
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Tracker snapshot failed", exc_info=task.exception())
+
+    def register_manifest(self, file_id: str, data: bytes) -> bool:
+        """Lưu manifest của file nếu manifest đúng là của fileID này."""
+        try:
+            manifest = Manifest.from_bytes(data)
+        except (ValueError, struct.error):
+            return False
+        if manifest.file_id() != file_id:
+            return False
+        if file_id not in self.manifests:
+            self.manifests[file_id] = bytes(data)
+            self.files.setdefault(file_id, FileInfo()).set_manifest(manifest, data)
+            self.log(TrackerStore.encode_manifest(file_id, data))
+        return True
+
+    def get_manifest(self, file_id: str) -> bytes:
+        """Trả về manifest của fileID, hoặc b'' nếu chưa có."""
+        return self.manifests.get(file_id, b'')
+
+    def get_peers(self, file_id: str, numwant: int = TrackerProtocol.DEFAULT_NUMWANT) -> bytes:
+        """Trả về tối đa numwant peer (chọn ngẫu nhiên) chia sẻ fileID, dạng compact."""
+        numwant = max(0, min(numwant, TrackerProtocol.MAX_NUMWANT))
+        swarm = self.peers.get(file_id)
+        if swarm is None:
+            return TrackerProtocol.encode_peers('', 0, b'')
+        return TrackerProtocol.encode_peers(self.files[file_id].name, len(swarm), swarm.sample(numwant))
+
+    def get_file_info(self, file_id: str) -> bytes:
+        """Trả về tên file, kích thước, kích thước chunk, số chunk và SHA-256 của manifest của fileID."""
+        info = self.files.get(file_id)
+        if info is None:
+            return TrackerProtocol.encode_file_info('', 0, 0, 0, b'')
+        return TrackerProtocol.encode_file_info(info.name, info.fileSize, info.chunkSize, info.chunkCount,
+                                                info.manifestDigest)
+
+    @staticmethod
+    def encode_blob(data: bytes) -> bytes:
+        """Phản hồi dạng blob: độ dài (4 bytes) + dữ liệu (đọc bằng TrackerProtocol.read_blob)."""
+        return TrackerProtocol.LENGTH.pack(len(data)) + data
+
+    def stats(self) -> dict:
+        """Số liệu hiện tại của tracker: số request, độ trễ xử lý và số file / peer đang theo dõi."""
+        return self.metrics.snapshot({'files': len(self.files), 'swarms': len(self.peers),
+                                      'peers': sum(len(swarm) for swarm in self.peers.values()),
+                                      'manifests': len(self.manifests), 'expiry_heap': len(self.expiry_heap)})
+
+    def scrape(self, file_id: str) -> tuple:
+        """Trả về (số seeder, số leecher) của fileID."""
+        swarm = self.peers.get(file_id)
+        return (0, 0) if swarm is None else swarm.counts()
 
     def remove_peer(self, file_id: str, ip: str, port: int):
         """Xóa peer khỏi danh sách chia sẻ file."""
-        with self.lock:
-            if file_id in self.peers:
-                self.peers[file_id] = [
-                    peer for peer in self.peers[file_id]
-                    if not (peer['ip'] == ip and peer['port'] == port)
-                ]
-                if not self.peers[file_id]:  # Xóa key nếu không còn peer
-                    del self.peers[file_id]
-            print(f"Peer removed: {ip}:{port} for fileID {file_id}")
+        swarm = self.peers.get(file_id)
+        if swarm is not None and swarm.remove((ip, port)):
+            self.log(TrackerStore.encode_peer_record(TrackerStore.REMOVE, file_id, TrackerProtocol.encode_peer(ip, port)))
+            if not swarm:  # Xóa key nếu không còn peer
+                del self.peers[file_id]
+            logger.debug("Peer removed: %s:%s for fileID %s", ip, port, file_id)
 
 if __name__ == "__main__":
-    tracker = TrackerServer()
-    tracker.start()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Tracker Server của hệ thống chia sẻ file P2P.")
+    parser.add_argument('--host', help=f"Địa chỉ lắng nghe (mặc định {SERVER_MASK}).")
+    parser.add_argument('--port', type=int, help=f"Cổng lắng nghe (mặc định {SERVER_PORT}, hoặc biến môi trường TRACKER_PORT).")
+    parser.add_argument('--state-dir', help="Lưu trạng thái tracker vào thư mục này để khôi phục khi khởi động lại.")
+    parser.add_argument('--log-level', default='INFO', help="Mức log (DEBUG để in từng kết nối và từng peer).")
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level.upper(), format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    tracker = TrackerServer(args.host, args.port, state_dir=args.state_dir)
+    tracker.start()
@@ -0,0 +1,165 @@
+import os
+import struct
+
+SNAPSHOT_FILE = 'tracker.snapshot'
+LOG_FILE = 'tracker.log'
+OLD_LOG_SUFFIX = '.old'     # Log đang được gộp vào snapshot mới
+COMPACT_MIN_BYTES = 16 * 1024 * 1024  # Không gộp log vào snapshot khi log còn nhỏ hơn mức này
+
+# Mỗi bản ghi: [loại (1 byte)] + [fileID (32 bytes)] + phần riêng của từng loại
+RECORD = struct.Struct('!B32s')
+NAME = 1       # + độ dài tên (2 bytes) + tên file (utf-8)
+REGISTER = 2   # + peer dạng compact (6 bytes, xem TrackerProtocol.PEER)
+REMOVE = 3     # + peer dạng compact (6 bytes)
+MANIFEST = 4   # + độ dài (4 bytes) + manifest
+NAME_LENGTH = struct.Struct('!H')
+BLOB_LENGTH = struct.Struct('!I')
+PEER_SIZE = 6
+
+
+def encode_name(file_id: str, name: str) -> bytes:
+    name = name.encode()
+    return RECORD.pack(NAME, bytes.fromhex(file_id)) + NAME_LENGTH.pack(len(name)) + name
+
+
+def encode_peer_record(kind: int, file_id: str, compact: bytes) -> bytes:
+    return RECORD.pack(kind, bytes.fromhex(file_id)) + compact
+
+
+def encode_manifest(file_id: str, data: bytes) -> bytes:
+    return RECORD.pack(MANIFEST, bytes.fromhex(file_id)) + BLOB_LENGTH.pack(len(data)) + data
+
+
+def decode_records(data: bytes):
+    """
+    Decode a sequence of records.
+    A truncated record at the end (the tracker stopped in the middle of a write) is ignored.
+    :return: A generator of (kind, file_id, value) tuples where value is the file name,
+             the compact peer or the manifest.
+    """
+    view = memoryview(data)
+    offset = 0
+    end = len(data)
+    while offset + RECORD.size <= end:
+        kind, raw_id = RECORD.unpack_from(view, offset)
+        offset += RECORD.size
+        if kind in (REGISTER, REMOVE):
+            size = PEER_SIZE
+        elif kind == NAME:
+            if offset + NAME_LENGTH.size > end:
+                return
+            size = NAME_LENGTH.unpack_from(view, offset)[0]
+            offset += NAME_LENGTH.size
+        elif kind == MANIFEST:
+            if offset + BLOB_LENGTH.size > end:
+                return
+            size = BLOB_LENGTH.unpack_from(view, offset)[0]
+            offset += BLOB_LENGTH.size
+        else:
+            raise ValueError(f"Unknown tracker record type {kind} at offset {offset - RECORD.size}")
+        if offset + size > end:
+            return
+        value = bytes(view[offset:offset + size])
+        offset += size
+        yield kind, raw_id.hex(), value.decode() if kind == NAME else value
+
+
+class TrackerStore:
+    def __init__(self, directory: str):
+        """
+        Persistent tracker state: a snapshot plus an append-only log of the changes made since.
+        Registrations, removals and manifests are appended to the log as they happen. When the
+        log grows larger than the snapshot it is compacted: the log is renamed to tracker.log.old
+        and a new log is started (begin_compact), then the current state is written to a
+        temporary file, fsynced and renamed over the snapshot, and the old log is deleted
+        (finish_compact, which can run in another thread while new records go to the new log).
+        Replaying the snapshot, the old log and the log restores the state; replaying a log on
+        top of a newer snapshot gives the same result, so a crash in the middle of a compaction
+        is safe.
+        :param directory: Directory holding tracker.snapshot and tracker.log (created if needed).
+        """
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.snapshotPath = os.path.join(directory, SNAPSHOT_FILE)
+        self.logPath = os.path.join(directory, LOG_FILE)
+        self.oldLogPath = self.logPath + OLD_LOG_SUFFIX
+        self.logObj = None
+        self.logSize = 0
+        self.snapshotSize = 0
+
+    def replay(self):
+        """
+        Read the snapshot and then the logs.
+        :return: A generator of (kind, file_id, value) records in the order they were written.
+        """
+        for path in (self.snapshotPath, self.oldLogPath, self.logPath):
+            try:
+                with open(path, 'rb') as f:
+                    data = f.read()
+            except FileNotFoundError:
+                continue
+            if path == self.snapshotPath:
+                self.snapshotSize = len(data)
+            yield from decode_records(data)
+
+    def open(self):
+        """Opens the log for appending (after replay)."""
+        self.logObj = open(self.logPath, 'ab')
+        self.logSize = self.logObj.tell()
+
+    def append(self, record: bytes):
+        """Appends an encoded record to the log (buffered until flush())."""
+        self.logObj.write(record)
+        self.logSize += len(record)
+
+    def flush(self):
+        """Writes the buffered records to the log file."""
+        if self.logObj is not None:
+            self.logObj.flush()
+
+    def should_compact(self) -> bool:
+        return self.logSize >= max(COMPACT_MIN_BYTES, self.snapshotSize)
+
+    def begin_compact(self):
+        """
+        Starts a compaction: the current log becomes the old log and new records go to an empty log.
+        Must be called at the moment the state passed to finish_compact is captured.
+        """
+        self.logObj.close()
+        if os.path.exists(self.oldLogPath):
+            # Lần gộp trước bị ngắt: nối log hiện tại vào log cũ để không mất bản ghi nào
+            with open(self.oldLogPath, 'ab') as old, open(self.logPath, 'rb') as current:
+                while data := current.read(1024 * 1024):
+                    old.write(data)
+            os.remove(self.logPath)
+        else:
+            os.replace(self.logPath, self.oldLogPath)
+        self.logObj = open(self.logPath, 'wb')
+        self.logSize = 0
+
+    def finish_compact(self, records):
+        """
+        Writes the state captured at begin_compact as the new snapshot and deletes the old log.
+        Only touches the snapshot files, so it can run in another thread while records are appended.
+        :param records: An iterable of encoded records.
+        """
+        temp_path = self.snapshotPath + '.tmp'
+        size = 0
+        with open(temp_path, 'wb') as f:
+            for record in records:
+                f.write(record)
+                size += len(record)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.snapshotPath)
+        self.snapshotSize = size
+        # Log cũ đã nằm trong snapshot mới
+        os.remove(self.oldLogPath)
+
+    def close(self):
+        """Flushes and closes the log."""
+        if self.logObj is not None:
+            self.logObj.flush()
+            os.fsync(self.logObj.fileno())
+            self.logObj.close()
+            self.logObj = None
@@ -0,0 +1,370 @@
+import os
+import time
+import logging
+import threading
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+PROGRESS_INTERVAL = 0.5   # Số giây giữa hai lần báo tiến độ của các transfer đang chạy
+RATE_WINDOW = 5.0         # Tốc độ được tính trên các mẫu trong chừng này giây gần nhất
+
+DOWNLOAD = 'download'
+UPLOAD = 'upload'
+
+# Trạng thái của một transfer
+RUNNING = 'running'
+PAUSED = 'paused'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+FINAL_STATES = (DONE, FAILED, CANCELLED)
+
+
+class Transfer:
+    def __init__(self, manager, kind: str, peer, target: str, work, on_progress=None, on_done=None):
+        """
+        Handle of one background upload or download, returned by TransferManager.
+        Progress, rate and ETA can be read from any thread. on_progress(transfer) is called
+        every PROGRESS_INTERVAL while the transfer runs and whenever its state changes;
+        on_done(transfer) is called once when it is done, failed or cancelled. Both go
+        through the manager's dispatch function.
+        :param kind: DOWNLOAD or UPLOAD.
+        :param peer: The Peer doing the transfer.
+        :param target: The fileID to download or the path of the file to upload.
+        :param work: Callable running the transfer in the worker thread; its result is kept in result().
+        """
+        self.manager = manager
+        self.kind = kind
+        self.peer = peer
+        self.target = target
+        self.work = work
+        self.on_progress = on_progress
+        self.on_done = on_done
+        self.fileID = target if kind == DOWNLOAD else None
+        self.seedPeer = None  # Peer chia sẻ tiếp file khi download xong (xem TransferManager.download)
+        self.state = RUNNING
+        self.error = None
+        self.value = None
+        self.started = time.monotonic()
+        self.finished = None
+        self.thread = None
+        self.restart = False  # resume() được gọi khi lần tải trước chưa dừng hẳn
+        self.samples = deque()  # (thời điểm, số byte đã xong) trong RATE_WINDOW giây gần nhất
+        self.done = threading.Event()
+
+    @property
+    def name(self) -> str:
+        """Tên file khi đã biết, nếu không thì fileID hoặc đường dẫn."""
+        file = self.peer.file if self.kind == DOWNLOAD else None
+        if file is not None:
+            return os.path.basename(file.fileName)
+        return os.path.basename(self.target) if self.kind == UPLOAD else self.target
+
+    def total_bytes(self) -> int:
+        """Kích thước file, hoặc 0 khi chưa biết (download chưa nhận được manifest)."""
+        if self.kind == UPLOAD:
+            try:
+                return os.path.getsize(self.target)
+            except OSError:
+                return 0
+        manifest = self.peer.manifest
+        return manifest.fileSize if manifest is not None else 0
+
+    def done_bytes(self) -> int:
+        """Số byte đã tải xong (download) hoặc đã băm và đăng ký với tracker (upload)."""
+        if self.kind == UPLOAD:
+            return self.total_bytes() if self.state == DONE else 0
+        manifest = self.peer.manifest
+        if manifest is None:
+            return 0
+        return min(manifest.fileSize, self.peer.numDownloaded * manifest.chunkSize)
+
+    def progress(self) -> float:
+        """Phần đã xong, từ 0.0 tới 1.0."""
+        if self.state == DONE:
+            return 1.0
+        total = self.total_bytes()
+        return self.done_bytes() / total if total else 0.0
+
+    def rate(self) -> float:
+        """Tốc độ trung bình (byte/s) trong RATE_WINDOW giây gần nhất, 0 khi không chạy."""
+        if self.state != RUNNING or len(self.samples) < 2:
+            return 0.0
+        (first_time, first_bytes), (last_time, last_bytes) = self.samples[0], self.samples[-1]
+        if last_time <= first_time:
+            return 0.0
+        return max(0.0, (last_bytes - first_bytes) / (last_time - first_time))
+
+    def eta(self):
+        """Số giây dự kiến còn lại, hoặc None khi chưa ước lượng được."""
+        if self.state == DONE:
+            return 0.0
+        rate = self.rate()
+        total = self.total_bytes()
+        if not rate or not total:
+            return None
+        return (total - self.done_bytes()) / rate
+
+    def sample(self, now: float):
+        """Ghi lại số byte đã xong để tính tốc độ (gọi bởi thread theo dõi của manager)."""
+        self.samples.append((now, self.done_bytes()))
+        while len(self.samples) > 2 and now - self.samples[0][0] > RATE_WINDOW:
+            self.samples.popleft()
+
+    def pause(self) -> bool:
+        """Tạm dừng một download (các chunk đã tải vẫn được giữ và chia sẻ). Trả về False nếu không tạm dừng được."""
+        return self.manager.pause(self)
+
+    def resume(self) -> bool:
+        """Tải tiếp một download đang tạm dừng."""
+        return self.manager.resume(self)
+
+    def cancel(self) -> bool:
+        """Huỷ transfer và ngừng chia sẻ file của nó. Trả về False nếu transfer đã kết thúc."""
+        return self.manager.cancel(self)
+
+    def wait(self, timeout: float = None) -> bool:
+        """Chờ transfer kết thúc (done, failed hoặc cancelled). Trả về False nếu hết thời gian chờ."""
+        return self.done.wait(timeout)
+
+    def result(self, timeout: float = None):
+        """
+        Wait for the transfer and return its result (the fileID for an upload).
+        :raises TimeoutError: If the transfer is still running after timeout seconds.
+        :raises RuntimeError: If the transfer was cancelled.
+        :raises Exception: The error of a failed transfer.
+        """
+        if not self.done.wait(timeout):
+            raise TimeoutError(f"{self.kind} of {self.name} is still {self.state}.")
+        if self.state == CANCELLED:
+            raise RuntimeError(f"{self.kind} of {self.name} was cancelled.")
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+    def __repr__(self):
+        return f"<Transfer {self.kind} {self.name} {self.state} {self.progress():.0%}>"
+
+
+class TransferManager:
+    def __init__(self, dispatch=None, progress_interval: float = PROGRESS_INTERVAL):
+        """
+        Runs uploads and downloads in background threads and reports their progress.
+        Every transfer runs in its own thread (a download also runs the Downloader threads of
+        its Peer), so one process can drive many transfers at once. A single monitor thread
+        samples the running transfers for their rate and calls their on_progress callbacks.
+        Pausing a download stops its Downloader and keeps the resume journal; resuming runs
+        the download again on the same Peer, which re-verifies and skips the chunks on disk.
+        :param dispatch: dispatch(callback, transfer) delivers a callback; it is called from
+                         worker and monitor threads, so a GUI passes a function that hands the
+                         call over to its own thread (for example through a queue drained with
+                         Tk's root.after). By default callbacks run in the calling thread.
+        :param progress_interval: Seconds between two on_progress calls of a running transfer.
+        """
+        self.dispatch = dispatch or (lambda callback, transfer: callback(transfer))
+        self.progress_interval = progress_interval
+        self.lock = threading.Lock()
+        self.transfers = []
+        self.monitor = None
+
+    def download(self, peer, fileID: str, on_progress=None, on_done=None, seed_peer=None, **kwargs) -> Transfer:
+        """
+        Start downloading fileID with peer (a Peer that is not downloading anything else).
+        peer is stopped once the download is done, failed or cancelled.
+        :param seed_peer: Peer that keeps sharing the file once it is downloaded, so finished
+                          downloads end up in one share index instead of keeping their own server.
+        :param kwargs: Passed to Peer.download_file (output_path, window, ...).
+        """
+        transfer = Transfer(self, DOWNLOAD, peer, fileID, lambda: peer.download_file(fileID, **kwargs),
+                            on_progress, on_done)
+        transfer.seedPeer = seed_peer
+        peer.download_stop.clear()
+        return self._start(transfer)
+
+    def upload(self, peer, filePath: str, on_progress=None, on_done=None, **kwargs) -> Transfer:
+        """
+        Start sharing filePath from peer; the result of the transfer is the fileID.
+        :param kwargs: Passed to Peer.share_file (chunk_size).
+        """
+        transfer = Transfer(self, UPLOAD, peer, filePath, lambda: peer.share_file(filePath, **kwargs),
+                            on_progress, on_done)
+        return self._start(transfer)
+
+    def active(self) -> list:
+        """Các transfer chưa kết thúc (đang chạy hoặc tạm dừng)."""
+        with self.lock:
+            return [transfer for transfer in self.transfers if transfer.state not in FINAL_STATES]
+
+    def pause(self, transfer: Transfer) -> bool:
+        with self.lock:
+            if transfer.kind != DOWNLOAD or transfer.state != RUNNING:
+                return False
+            transfer.state = PAUSED
+            transfer.samples.clear()
+        transfer.peer.stop_download()
+        self._notify(transfer.on_progress, transfer)
+        return True
+
+    def resume(self, transfer: Transfer) -> bool:
+        with self.lock:
+            if transfer.state != PAUSED:
+                return False
+            transfer.state = RUNNING
+            if transfer.thread is not None and transfer.thread.is_alive():
+                # Lần tải trước vẫn đang dừng lại: thread của nó sẽ tải lại khi dừng xong
+                transfer.restart = True
+                self._ensure_monitor()
+            else:
+                transfer.peer.download_stop.clear()
+                self._spawn(transfer, self._run)
+        self._notify(transfer.on_progress, transfer)
+        return True
+
+    def cancel(self, transfer: Transfer) -> bool:
+        with self.lock:
+            if transfer.state in FINAL_STATES:
+                return False
+            running = transfer.thread is not None and transfer.thread.is_alive()
+            transfer.state = CANCELLED
+            if not running:
+                # Download đang tạm dừng: chỉ còn dọn dẹp
+                self._spawn(transfer, self._cleanup)
+        if running and transfer.kind == DOWNLOAD:
+            transfer.peer.stop_download()
+        return True
+
+    def close(self):
+        """Huỷ mọi transfer chưa kết thúc và chờ chúng dừng hẳn."""
+        for transfer in self.active():
+            transfer.cancel()
+        for transfer in list(self.transfers):
+            transfer.wait()
+
+    def shutdown(self):
+        """Tạm dừng mọi download đang chạy (giữ journal để lần sau tải tiếp) và dừng Peer của các download chưa xong."""
+        for transfer in self.active():
+            if transfer.kind == DOWNLOAD:
+                transfer.pause()
+                transfer.peer.stop_peer_server()
+
+    def _start(self, transfer: Transfer) -> Transfer:
+        with self.lock:
+            self.transfers.append(transfer)
+            self._spawn(transfer, self._run)
+        return transfer
+
+    def _spawn(self, transfer: Transfer, target):
+        """Chạy target(transfer) trong thread của transfer và bật thread theo dõi nếu cần (giữ lock khi gọi)."""
+        transfer.thread = threading.Thread(target=target, args=(transfer,), daemon=True)
+        transfer.thread.start()
+        self._ensure_monitor()
+
+    def _ensure_monitor(self):
+        """Bật thread theo dõi nếu nó chưa chạy (giữ lock khi gọi)."""
+        if self.monitor is None:
+            self.monitor = threading.Thread(target=self._monitor, daemon=True)
+            self.monitor.start()
+
+    def _run(self, transfer: Transfer):
+        """Thread của transfer: chạy work() rồi cập nhật trạng thái theo kết quả."""
+        while True:
+            try:
+                value, error = transfer.work(), None
+            except Exception as e:
+                value, error = None, e
+            with self.lock:
+                if transfer.restart and transfer.state == RUNNING and error is not None:
+                    transfer.restart = False
+                    transfer.peer.download_stop.clear()
+                    continue
+                transfer.restart = False
+                break
+        with self.lock:
+            state = transfer.state
+            if state == PAUSED and error is None:
+                state = RUNNING  # Tải xong ngay trước khi bị tạm dừng
+            if state == RUNNING:
+                transfer.value, transfer.error = value, error
+                if transfer.kind == UPLOAD and error is None:
+                    transfer.fileID = value
+                transfer.state = FAILED if error is not None else DONE
+        if state == PAUSED:
+            logger.info("Paused %s of %s at %.0f%%.", transfer.kind, transfer.name, 100 * transfer.progress())
+        elif state == CANCELLED:
+            if transfer.kind == UPLOAD and error is None:
+                transfer.fileID = value
+            self._cleanup(transfer)
+        else:
+            if error is not None:
+                logger.error("%s of %s failed: %s", transfer.kind.capitalize(), transfer.name, error)
+            if transfer.kind == DOWNLOAD:
+                self._release_peer(transfer)
+            self._finish(transfer)
+
+    def _cleanup(self, transfer: Transfer):
+        """Ngừng chia sẻ file của một transfer đã bị huỷ; download còn dừng cả Peer riêng của nó."""
+        if transfer.kind == DOWNLOAD:
+            self._release_peer(transfer)
+        else:
+            self._unshare(transfer.peer, transfer.fileID)
+        logger.info("Cancelled %s of %s.", transfer.kind, transfer.name)
+        self._finish(transfer)
+
+    def _release_peer(self, transfer: Transfer):
+        """Dừng Peer riêng của một download đã kết thúc; file tải xong được chuyển sang seed peer để tiếp tục chia sẻ."""
+        peer = transfer.peer
+        peer.stop_peer_server()
+        self._unshare(peer, transfer.fileID)
+        if transfer.state == DONE and transfer.seedPeer is not None:
+            try:
+                transfer.seedPeer.seed_file(peer.file)
+            except (OSError, ValueError) as e:
+                logger.warning("Unable to keep sharing %s: %s", transfer.name, e)
+
+    def _unshare(self, peer, fileID: str):
+        try:
+            if fileID is not None:
+                peer.unshare_file(fileID)
+        except OSError as e:
+            logger.warning("Unable to remove %s from the tracker: %s", fileID, e)
+
+    def _finish(self, transfer: Transfer):
+        transfer.finished = time.monotonic()
+        transfer.samples.clear()
+        transfer.done.set()
+        self._notify(transfer.on_progress, transfer)
+        self._notify(transfer.on_done, transfer)
+
+    def _monitor(self):
+        """Lấy mẫu tiến độ của các transfer đang chạy và gọi on_progress; dừng khi không còn transfer nào chạy."""
+        try:
+            while True:
+                with self.lock:
+                    running = [transfer for transfer in self.transfers if transfer.state == RUNNING]
+                    if not running:
+                        self.monitor = None
+                        return
+                now = time.monotonic()
+                for transfer in running:
+                    # Lỗi của một transfer không được làm dừng tiến độ của các transfer khác
+                    try:
+                        transfer.sample(now)
+                    except Exception:
+                        logger.exception("Unable to sample the progress of %r.", transfer.target)
+                        continue
+                    self._notify(transfer.on_progress, transfer)
+                time.sleep(self.progress_interval)
+        finally:
+            # Thread dừng vì lỗi: cho phép _ensure_monitor bật lại thread theo dõi
+            with self.lock:
+                if self.monitor is threading.current_thread():
+                    self.monitor = None
+
+    def _notify(self, callback, transfer: Transfer):
+        if callback is None:
+            return
+        try:
+            self.dispatch(callback, transfer)
+        except Exception:
+            logger.exception("Transfer callback failed.")
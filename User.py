@@ -1,12 +1,18 @@
 import socket
+import threading
 from Peer import Peer
+from TransferManager import TransferManager
 
 class User:
-    def __init__(self, user_id, username, password):
+    def __init__(self, user_id, username, password, dispatch=None):
         self.userID = user_id          # Unique ID for the user
         self.username = username       # Username for authentication
         self.password = password       # Password for authentication
         self.peerList = []  # Initialize peer list
+        self.seedPeer = None  # Peer dùng chung (một cổng, một server) để chia sẻ mọi file của user
+        self.lock = threading.Lock()
+        # Các upload / download chạy nền; dispatch chuyển callback tiến độ sang thread của giao diện (xem TransferManager)
+        self.transfers = TransferManager(dispatch)
 
     def register(self):
         pass
@@ -24,25 +30,55 @@ class User:
     def logout(self):
         print(f"User {self.username} logged out.")
     
-    # Request to upload a file (share)
+    # Request to upload (share) files; blocks until they are shared. filePath is one path (returns its fileID)
+    # or a list of paths, all published and announced over one tracker connection (returns their fileIDs)
     def upload_file(self, filePath):
+        filePaths = [filePath] if isinstance(filePath, str) else list(filePath)
+        print(f"User {self.username} requests to upload {len(filePaths)} file(s): {', '.join(filePaths)}")
+        fileIDs = self.get_seed_peer().share_files(filePaths)
+        return fileIDs[0] if isinstance(filePath, str) else fileIDs
+
+    # Start sharing a file in the background; returns a Transfer whose result is the fileID
+    def start_upload(self, filePath, on_progress=None, on_done=None):
         print(f"User {self.username} requests to upload file: {filePath}")
+        return self.transfers.upload(self.get_seed_peer(), filePath, on_progress, on_done)
 
-        peer_host, peer_port = self.get_ip_port() 
-        peer = Peer(peer_host, peer_port)
-        self.peerList.append(peer)
-        peer.share_file(filePath)
+    # The Peer sharing every file of the user, created on first use
+    def get_seed_peer(self):
+        with self.lock:
+            if self.seedPeer is None:
+                peer_host, peer_port = self.get_ip_port()
+                self.seedPeer = Peer(peer_host, peer_port)
+                self.peerList.append(self.seedPeer)
+            return self.seedPeer
+
+    # Stop sharing a file uploaded with upload_file
+    def stop_sharing(self, fileID: str) -> bool:
+        if self.seedPeer is None:
+            return False
+        return self.seedPeer.unshare_file(fileID)
+
+    # Request to download a file; blocks until the download is done
+    def download_file(self, fileID: str, totalChunks: int = None):
+        self.start_download(fileID, totalChunks=totalChunks).result()
 
-    # Request to download a file
-    def download_file(self, fileID: str, totalChunks: int):
+    # Start downloading a file in the background; returns a Transfer. Each download uses its own Peer, which
+    # the TransferManager stops once the download ends; a downloaded file is then shared by the seed Peer
+    def start_download(self, fileID: str, on_progress=None, on_done=None, **kwargs):
         print(f"User {self.username} requests to download file: {fileID}")
 
-        peer_host, peer_port = self.get_ip_port() 
-        print(peer_host, peer_port)
+        peer_host, peer_port = self.get_ip_port()
         peer = Peer(peer_host, peer_port)
-        self.peerList.append(peer)
-        peer.download_file(fileID, totalChunks)
+        return self.transfers.download(peer, fileID, on_progress, on_done, seed_peer=self.get_seed_peer(), **kwargs)
+
 
+    # Stop every Peer of the user before exiting: unfinished downloads are paused (their journals are kept)
+    def close(self):
+        self.transfers.shutdown()
+        with self.lock:
+            seedPeer = self.seedPeer
+        if seedPeer is not None:
+            seedPeer.stop_peer_server()
 
     def stop(self, peerID):
         self.peerList[peerID].stop_peer_server()
@@ -1,13 +1,36 @@
 import uuid
+import queue
+import logging
 import tkinter as tk
-from tkinter import filedialog, messagebox, simpledialog
+from tkinter import ttk, filedialog, messagebox, simpledialog
 from User import User
 
+POLL_INTERVAL = 100  # ms giữa hai lần chuyển callback của các transfer sang thread Tk
+
+
+def format_size(n: float) -> str:
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if n < 1024:
+            return f"{n:.0f} {unit}" if unit == 'B' else f"{n:.1f} {unit}"
+        n /= 1024
+    return f"{n:.1f} TB"
+
+
+def format_eta(seconds) -> str:
+    if seconds is None:
+        return '-'
+    seconds = int(seconds)
+    return f"{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
 class FileApp:
     def __init__(self, root):
         self.root = root
         self.root.title("File Sharing App")
         self.user = None
+        # Callback của các transfer đến từ thread khác; chỉ thread Tk được đụng vào widget nên chúng được
+        # xếp hàng ở đây và chạy trong poll_callbacks (root.after)
+        self.callbacks = queue.Queue()
+        self.rows = {}  # Transfer -> id của dòng trong bảng
 
         # Login Frame
         self.login_frame = tk.Frame(self.root)
@@ -33,7 +56,7 @@ class FileApp:
 
         if username and password:
             user_id = uuid.getnode()
-            self.user = User(user_id=user_id, username=username, password=password)
+            self.user = User(user_id=user_id, username=username, password=password, dispatch=self.dispatch)
             messagebox.showinfo("Success", "Logged in successfully!")
             self.show_menu()
         else:
@@ -43,29 +66,101 @@ class FileApp:
         self.login_frame.pack_forget()
         self.menu_frame.pack(pady=20)
 
-        tk.Button(self.menu_frame, text="Upload File", command=self.upload_file).pack(pady=5)
-        tk.Button(self.menu_frame, text="Download File", command=self.download_file).pack(pady=5)
-        tk.Button(self.menu_frame, text="Exit", command=self.root.quit).pack(pady=5)
+        buttons = tk.Frame(self.menu_frame)
+        buttons.pack()
+        tk.Button(buttons, text="Upload File", command=self.upload_file).pack(side=tk.LEFT, padx=5)
+        tk.Button(buttons, text="Download File", command=self.download_file).pack(side=tk.LEFT, padx=5)
+        tk.Button(buttons, text="Pause", command=lambda: self.control('pause')).pack(side=tk.LEFT, padx=5)
+        tk.Button(buttons, text="Resume", command=lambda: self.control('resume')).pack(side=tk.LEFT, padx=5)
+        tk.Button(buttons, text="Cancel", command=lambda: self.control('cancel')).pack(side=tk.LEFT, padx=5)
+        tk.Button(buttons, text="Exit", command=self.exit).pack(side=tk.LEFT, padx=5)
+
+        # Bảng các transfer đang chạy và đã xong
+        columns = ('kind', 'name', 'state', 'progress', 'rate', 'eta')
+        self.table = ttk.Treeview(self.menu_frame, columns=columns, show='headings', height=12)
+        for column, title, width in zip(columns, ('Type', 'File', 'State', 'Progress', 'Rate', 'ETA'),
+                                        (80, 240, 80, 120, 90, 70)):
+            self.table.heading(column, text=title)
+            self.table.column(column, width=width)
+        self.table.pack(pady=10, fill=tk.BOTH, expand=True)
+        self.root.after(POLL_INTERVAL, self.poll_callbacks)
+
+    def dispatch(self, callback, transfer):
+        """Chạy trong thread của transfer: chuyển callback sang thread Tk."""
+        self.callbacks.put((callback, transfer))
+
+    def poll_callbacks(self):
+        try:
+            while True:
+                try:
+                    callback, transfer = self.callbacks.get_nowait()
+                except queue.Empty:
+                    break
+                # Một callback lỗi không được làm dừng việc cập nhật giao diện
+                try:
+                    callback(transfer)
+                except Exception:
+                    logging.exception("Transfer callback failed.")
+        finally:
+            self.root.after(POLL_INTERVAL, self.poll_callbacks)
+
+    def show_transfer(self, transfer):
+        total = transfer.total_bytes()
+        values = (transfer.kind, transfer.name, transfer.state,
+                  f"{transfer.progress():.0%} of {format_size(total)}" if total else '-',
+                  f"{format_size(transfer.rate())}/s", format_eta(transfer.eta()))
+        row = self.rows.get(transfer)
+        if row is None:
+            self.rows[transfer] = self.table.insert('', tk.END, values=values)
+        else:
+            self.table.item(row, values=values)
+
+    def transfer_done(self, transfer):
+        if transfer.state == 'done' and transfer.kind == 'upload':
+            messagebox.showinfo("Success", f"File shared successfully!\nFile ID: {transfer.fileID}")
+        elif transfer.state == 'done':
+            messagebox.showinfo("Success", f"{transfer.name} downloaded successfully!")
+        elif transfer.state == 'failed':
+            messagebox.showerror("Error", f"{transfer.kind.capitalize()} of {transfer.name} failed: {transfer.error}")
+
+    def selected_transfers(self) -> list:
+        selected = set(self.table.selection())
+        return [transfer for transfer, row in self.rows.items() if row in selected]
+
+    def control(self, action: str):
+        transfers = self.selected_transfers()
+        if not transfers:
+            messagebox.showerror("Error", "No transfer selected")
+        for transfer in transfers:
+            getattr(transfer, action)()
 
     def upload_file(self):
         file_path = filedialog.askopenfilename(title="Select a file")
         if file_path:
-            self.user.upload_file(filePath=file_path)
-            messagebox.showinfo("Success", "File uploaded successfully!")
+            transfer = self.user.start_upload(file_path, on_progress=self.show_transfer, on_done=self.transfer_done)
+            self.show_transfer(transfer)
         else:
             messagebox.showerror("Error", "No file selected")
 
     def download_file(self):
         file_id = simpledialog.askstring("File Download", "Enter File ID")
-        total_chunks = simpledialog.askstring("File Download", "Enter File Total chunks")
         if file_id:
-            self.user.download_file(fileID=file_id, totalChunks=int(total_chunks))
-            messagebox.showinfo("Success", "File downloaded successfully!")
+            transfer = self.user.start_download(file_id.strip(), on_progress=self.show_transfer,
+                                                on_done=self.transfer_done)
+            self.show_transfer(transfer)
         else:
             messagebox.showerror("Error", "No File ID entered")
 
+    def exit(self):
+        if self.user is not None:
+            # Tạm dừng các download (giữ journal để lần sau tải tiếp) và dừng server của mọi Peer,
+            # nếu không các thread server sẽ giữ tiến trình chạy tiếp sau khi đóng cửa sổ
+            self.user.close()
+        self.root.quit()
+
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
     root = tk.Tk()
     app = FileApp(root)
     root.mainloop()
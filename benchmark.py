@@ -0,0 +1,254 @@
+import os
+import sys
+import time
+import json
+import mmap
+import socket
+import hashlib
+import argparse
+import resource
+import tempfile
+import threading
+import contextlib
+import multiprocessing
+import ChunkHasher
+import TrackerProtocol
+from Peer import Peer
+from TrackerServer import TrackerServer
+
+BENCH_HOST = '127.0.0.1'
+
+
+def generate_file(path: str, size: int):
+    """Tạo file dữ liệu ngẫu nhiên có kích thước size byte."""
+    block = os.urandom(1024 * 1024)
+    with open(path, 'wb') as f:
+        remaining = size
+        while remaining > 0:
+            f.write(block[:remaining])
+            remaining -= len(block)
+
+
+def serial_hash(view: memoryview, chunk_size: int):
+    """Cách cũ: một lượt SHA-256 cả file cộng với hash tuần tự từng chunk trên một core."""
+    sha256 = hashlib.sha256()
+    sha256.update(view)
+    ChunkHasher.hash_chunks(view, chunk_size, workers=1)
+    return sha256.hexdigest()
+
+
+def parallel_hash(view: memoryview, chunk_size: int, workers: int):
+    """Cách mới: hash các chunk song song rồi lấy Merkle root làm hash của file."""
+    digests = ChunkHasher.hash_chunks(view, chunk_size, workers)
+    return ChunkHasher.merkle_root(digests).hex()
+
+
+def bench_hashing(args) -> list:
+    """So sánh thời gian hash tuần tự và song song cho từng kích thước file."""
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for size_mb in args.sizes:
+            path = os.path.join(tmp, f'{size_mb}MB.bin')
+            size = int(size_mb * 1024 * 1024)
+            generate_file(path, size)
+            with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                view = memoryview(mm)
+                for name, run in (('serial', lambda: serial_hash(view, args.chunk_size)),
+                                  ('parallel', lambda: parallel_hash(view, args.chunk_size, args.workers))):
+                    best = min(timed(run) for _ in range(args.repeat))
+                    results.append({'benchmark': 'hashing', 'mode': name, 'size': size,
+                                    'chunk_size': args.chunk_size, 'workers': 1 if name == 'serial' else args.workers,
+                                    'seconds': best, 'mb_per_s': size / 1024 / 1024 / best if best else None})
+                    print(f"hashing {name:8} {size_mb:>8} MB  {best:8.3f} s  "
+                          f"{results[-1]['mb_per_s'] or 0:10.1f} MB/s")
+                view.release()
+    return results
+
+
+class TimedPeer(Peer):
+    """Peer ghi lại thời điểm nhận được chunk đầu tiên (time-to-first-byte)."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.firstChunkAt = None
+
+    def notify_have(self, fileID: str, chunk_num: int):
+        if self.firstChunkAt is None:
+            self.firstChunkAt = time.perf_counter()
+        super().notify_have(fileID, chunk_num)
+
+
+def free_port() -> int:
+    """Tìm một cổng TCP trống trên loopback."""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind((BENCH_HOST, 0))
+        return s.getsockname()[1]
+
+
+def role_usage(role: str, index: int = 0) -> dict:
+    """Peak RSS và thời gian CPU của process hiện tại (mỗi vai trò chạy trong process riêng)."""
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    # ru_maxrss tính bằng KB trên Linux
+    return {'benchmark': 'swarm', 'role': role, 'index': index, 'peak_rss_kb': usage.ru_maxrss,
+            'cpu_seconds': usage.ru_utime + usage.ru_stime}
+
+
+def tracker_process(port_queue, stop, results):
+    """Chạy TrackerServer trên một cổng trống cho tới khi stop được set."""
+    with contextlib.redirect_stdout(open(os.devnull, 'w')):
+        tracker = TrackerServer(BENCH_HOST, 0)
+        thread = threading.Thread(target=tracker.start)
+        thread.start()
+        port_queue.put(tracker.port)
+        stop.wait()
+        tracker.close()
+        thread.join()
+    results.put(role_usage('tracker'))
+
+
+def seeder_process(index, tracker_port, paths, ready, stop, results):
+    """Chia sẻ mọi file trong paths cho tới khi stop được set."""
+    with contextlib.redirect_stdout(open(os.devnull, 'w')):
+        peer = Peer(BENCH_HOST, free_port(), tracker_host=BENCH_HOST, tracker_port=tracker_port)
+        fileIDs = peer.share_files(paths)
+        ready.put(fileIDs)
+        stop.wait()
+        peer.stop_peer_server()
+    results.put(role_usage('seeder', index))
+
+
+def leecher_process(index, tracker_port, files, out_dir, start, stop, downloads, results):
+    """Tải lần lượt các file (fileID, size), ghi thời gian tải và time-to-first-byte của từng file."""
+    transfers = []
+    with contextlib.redirect_stdout(open(os.devnull, 'w')):
+        peer = TimedPeer(BENCH_HOST, free_port(), tracker_host=BENCH_HOST, tracker_port=tracker_port)
+        start.wait()
+        for fileID, size in files:
+            peer.firstChunkAt = None
+            began = time.perf_counter()
+            result = {'benchmark': 'swarm', 'role': 'download', 'index': index, 'size': size}
+            try:
+                peer.download_file(fileID, output_path=os.path.join(out_dir, f'leecher{index}-{fileID[:16]}.bin'))
+            except (OSError, RuntimeError, ValueError) as e:
+                result['error'] = repr(e)
+            seconds = time.perf_counter() - began
+            result.update({'chunk_size': peer.manifest.chunkSize if peer.manifest else None, 'seconds': seconds,
+                           'mb_per_s': size / 1024 / 1024 / seconds if seconds else None,
+                           'ttfb': peer.firstChunkAt - began if peer.firstChunkAt else None})
+            transfers.append(result)
+        # Vẫn chia sẻ lại cho các leecher khác cho tới khi benchmark kết thúc
+        downloads.put(transfers)
+        stop.wait()
+        peer.stop_peer_server()
+    results.put(role_usage('leecher', index))
+
+
+def bench_announces(tracker_port: int, count: int) -> dict:
+    """Đo số announce/s của tracker: count request POST gửi liên tiếp (pipeline) trên một kết nối."""
+    fileID = hashlib.sha256(b'benchmark').hexdigest()
+    requests = b''.join(f"POST announce.bin {fileID} 1 10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255} {1024 + i % 60000}\n"
+                        .encode() for i in range(count))
+    with socket.create_connection((BENCH_HOST, tracker_port)) as client_socket, \
+            client_socket.makefile('rb') as stream:
+        began = time.perf_counter()
+        client_socket.sendall(requests)
+        for _ in range(count):
+            stream.readline()
+        seconds = time.perf_counter() - began
+        client_socket.sendall(f"GET {fileID} 1\n".encode())
+        TrackerProtocol.read_peers(stream)
+    return {'benchmark': 'swarm', 'role': 'announce', 'count': count, 'seconds': seconds,
+            'announces_per_s': count / seconds if seconds else None}
+
+
+def bench_swarm(args) -> list:
+    """
+    Chạy một tracker, N seeder và M leecher trên loopback, mỗi vai trò một process.
+    Các seeder chia sẻ cùng các file sinh ngẫu nhiên; các leecher tải song song mọi file.
+    """
+    context = multiprocessing.get_context('spawn')
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        paths, sizes = [], []
+        for size_mb in args.sizes:
+            path = os.path.join(tmp, f'{size_mb}MB.bin')
+            size = int(size_mb * 1024 * 1024)
+            generate_file(path, size)
+            paths.append(path)
+            sizes.append(size)
+        queue, usage = context.Queue(), context.Queue()
+        stop, start = context.Event(), context.Event()
+        tracker = context.Process(target=tracker_process, args=(queue, stop, usage))
+        tracker.start()
+        tracker_port = queue.get()
+        seeders = [context.Process(target=seeder_process, args=(i, tracker_port, paths, queue, stop, usage))
+                   for i in range(args.seeders)]
+        for process in seeders:
+            process.start()
+        # Mọi seeder chia sẻ cùng các file nên có cùng các fileID
+        fileIDs = [queue.get() for _ in seeders][0]
+        leechers = [context.Process(target=leecher_process,
+                                    args=(i, tracker_port, list(zip(fileIDs, sizes)), tmp, start, stop, queue, usage))
+                    for i in range(args.leechers)]
+        for process in leechers:
+            process.start()
+        start.set()
+        for _ in leechers:
+            results.extend(queue.get())
+        results.append(bench_announces(tracker_port, args.announces))
+        stop.set()
+        processes = [tracker] + seeders + leechers
+        results.extend(usage.get() for _ in processes)
+        for process in processes:
+            process.join()
+
+    for result in results:
+        if result['role'] == 'download' and 'error' in result:
+            print(f"download leecher {result['index']:<3} failed: {result['error']}")
+        elif result['role'] == 'download':
+            print(f"download leecher {result['index']:<3} {result['size'] / 1024 / 1024:>10.3f} MB  "
+                  f"{result['seconds']:8.3f} s  {result['mb_per_s'] or 0:10.1f} MB/s  ttfb {result['ttfb'] or 0:.4f} s")
+        elif result['role'] == 'announce':
+            print(f"tracker  {result['count']} announces  {result['announces_per_s']:10.0f} announces/s")
+        else:
+            print(f"{result['role']:8} {result['index']:<3} peak RSS {result['peak_rss_kb'] / 1024:8.1f} MB  "
+                  f"CPU {result['cpu_seconds']:8.3f} s")
+    return results
+
+
+def timed(run) -> float:
+    start = time.perf_counter()
+    run()
+    return time.perf_counter() - start
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks cho hệ thống chia sẻ file P2P.")
+    sub = parser.add_subparsers(dest='benchmark', required=True)
+
+    hashing = sub.add_parser('hashing', help="So sánh hash tuần tự và hash song song (Merkle root).")
+    hashing.add_argument('--sizes', type=float, nargs='+', default=[16, 256], help="Kích thước file (MB).")
+    hashing.add_argument('--chunk-size', type=int, default=8192)
+    hashing.add_argument('--workers', type=int, default=ChunkHasher.default_workers())
+    hashing.add_argument('--repeat', type=int, default=3)
+    hashing.add_argument('--json', help="Ghi kết quả dạng JSON vào file này.")
+    hashing.set_defaults(run=bench_hashing)
+
+    swarm = sub.add_parser('swarm', help="Tracker, seeder và leecher thật trên loopback (127.0.0.1).")
+    swarm.add_argument('--sizes', type=float, nargs='+', default=[0.0625, 16, 256],
+                       help="Kích thước các file được chia sẻ (MB, có thể lẻ để tạo file vài KB).")
+    swarm.add_argument('--seeders', type=int, default=2)
+    swarm.add_argument('--leechers', type=int, default=4)
+    swarm.add_argument('--announces', type=int, default=20000, help="Số announce gửi tới tracker để đo announces/s.")
+    swarm.add_argument('--json', help="Ghi kết quả dạng JSON vào file này.")
+    swarm.set_defaults(run=bench_swarm)
+
+    args = parser.parse_args(argv)
+    results = args.run(args)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,18 +1,56 @@
 from User import User
 import uuid
+import logging
+
+def show(transfers):
+    for i, transfer in enumerate(transfers):
+        eta = transfer.eta()
+        print(f"{i}. {transfer.kind} {transfer.name} {transfer.state} {transfer.progress():.0%} "
+              f"{transfer.rate() / 1024:.1f} KB/s ETA {'-' if eta is None else f'{eta:.0f}s'}")
+
+def done(transfer):
+    if transfer.state == 'failed':
+        print(f"\n{transfer.kind} of {transfer.name} failed: {transfer.error}")
+    elif transfer.kind == 'upload' and transfer.state == 'done':
+        print(f"\nShared {transfer.name}, ID: {transfer.fileID}")
+    else:
+        print(f"\n{transfer.kind} of {transfer.name} {transfer.state}")
+
 def app():
     id = uuid.getnode()
     username = input("username: ")
     password = input("password: ")
     user = User(id, username, password)
 
-    x = int(input("1. Share 2. Download\n"))
-    if x == 1:
-        filePath = input('File Path: ')
-        user.upload_file(filePath=filePath)
-    else:
-        fileID = input('ID: ')
-        total_chunks = int(input('Chunks: '))
-        user.download_file(fileID, total_chunks)
+    # Các upload / download chạy nền, có thể bắt đầu nhiều transfer trong cùng một tiến trình
+    transfers = []
+    while True:
+        x = input("1. Share 2. Download 3. List 4. Pause 5. Resume 6. Cancel 0. Exit\n").strip()
+        if x == '1':
+            filePath = input('File Path: ')
+            transfers.append(user.start_upload(filePath, on_done=done))
+        elif x == '2':
+            fileID = input('ID: ')
+            transfers.append(user.start_download(fileID.strip(), on_done=done))
+        elif x == '3':
+            show(transfers)
+        elif x in ('4', '5', '6'):
+            show(transfers)
+            try:
+                transfer = transfers[int(input('Transfer: '))]
+            except (ValueError, IndexError):
+                print('Invalid transfer.')
+                continue
+            action = {'4': transfer.pause, '5': transfer.resume, '6': transfer.cancel}[x]
+            if not action():
+                print(f"Unable to do that while the transfer is {transfer.state}.")
+        elif x == '0':
+            # Chờ các transfer còn chạy xong trước khi thoát
+            for transfer in user.transfers.active():
+                if transfer.state == 'running':
+                    transfer.wait()
+            user.close()
+            break
 
+logging.basicConfig(level=logging.INFO, format='%(message)s')
 app()
\ No newline at end of file